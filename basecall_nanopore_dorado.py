@@ -1,30 +1,66 @@
 import os
+import sys
+import copy
+import time
+import json
+import shutil
+from glob import glob
+from concurrent import futures
 from argparse import ArgumentParser
 from multiprocessing import cpu_count
 from psutil import virtual_memory
 from basecall_nanopore_dorado_methods import Methods
 from importlib.resources import files
 from conda_methods import CondaMethods
+from watch_methods import WatchMethods
+from shard_methods import ShardMethods
+from server_methods import ServerMethods
+from ledger_methods import LedgerMethods
+from inventory_methods import InventoryMethods
+from pipeline_methods import StageScheduler, JobSizing
+from report_methods import RunReport
+from process_methods import ProcessManager
+from staging_methods import StagingMethods, WriteBack
+from cache_methods import StageCache
 
-# pandas=2.2.2 psutil=5.9.8
+# numpy psutil=5.9.8
 
 
 __author__ = 'duceppemo'
 __version__ = '0.1'
 
 
-# TODO: create log of versions and time stamps for QA
-
 class Basecaller(object):
-    def __init__(self, args):
+    def __init__(self, args, run=True):
         # I/O
         self.input = os.path.abspath(args.input)
         self.output_folder = os.path.abspath(args.output)
+        self.inventory_file = self.output_folder + '/raw_inventory.json'
+        # Intermediate files go to the local scratch folder when there is one, the outputs are copied back
+        self.scratch = args.scratch
+        self.work_folder = StagingMethods.work_folder(self.scratch, self.output_folder) if self.scratch \
+            else self.output_folder
+
+        # Output folders to create
+        self.basecalled_folder = self.work_folder + '/1_basecalled/'
+        self.qc_folder = self.work_folder + '/2_qc/'
+        self.filtered_folder = self.work_folder + '/3_filtered/'
+        # Raw files already basecalled by an interrupted run are recorded here
+        self.ledger_file = self.basecalled_folder + 'basecalling_ledger.tsv'
+
+        # Results of the previous invocations, reused when their inputs and settings did not change
+        self.cache = StageCache(self.output_folder + '/stage_cache.json', self.work_folder, self.output_folder)
+        self.basecall_key = None
+        self.do_basecall = True
 
         # Performance
         self.cpu = args.threads
         self.parallel = args.parallel
         self.mem = args.memory
+        self.buffer_size = args.buffer_size
+        self.gzi = args.gzi
+        self.prefetch = args.prefetch
+        self.prefetch_size = args.prefetch_size
 
         # Dorado related
         self.gpu = args.gpu
@@ -39,26 +75,264 @@ class Basecaller(object):
         self.min_qscore = args.min_qscore
         self.port = args.port
         self.recursive = args.recursive
+        self.keep_server = args.keep_server
+        self.server_timeout = args.server_timeout
+        if args.tool_timeout:
+            ProcessManager.timeout = args.tool_timeout * 60
+        self.watch = args.watch
+        self.poll_interval = args.poll_interval
+        self.watch_timeout = args.watch_timeout
+        self.batch_size = args.batch_size
+        self.filter_engine = args.filter_engine
+        self.genome_size = args.genome_size
+        self.depth = args.depth
+        self.qc_engine = args.qc_engine
         self.workflows = str(files('data').joinpath('workflows.tsv'))
 
         # Data
         self.sample_dict = dict()
+        self.targets = dict()  # Sample -> bases to keep when filtering (genome size x depth)
 
         # Conda
         self.pycoQC_env_path = ''
         self.nbc_env_path = ''
 
+        self.inventory = None
+        self.report = None
+        self.write_back = None
+        self.basecalled_copies = list()
+        self.dropped = list()  # Barcodes deleted because they are not in the description file
+
         # Run
-        self.run()
+        if run:
+            self.run()
+
+    def target(self, sample):
+        # Samples missing from the description file get the "--genome-size" and "--depth" target
+        return self.targets.get(sample, self.targets.get(None))
+
+    def basecalling_key(self):
+        # Settings that change the basecalled reads. Sample names are handled per sample (see "relabel_samples").
+        return StageCache.make_key(config=self.config, flowcell=self.flowcell, library_kit=self.library_kit,
+                                   sequencer=self.sequencer, barcode_kit=self.barcode_kit,
+                                   min_qscore=self.min_qscore)
+
+    def sample_names(self):
+        # Barcode -> sample name, from the description file
+        return Methods.parse_samples(self.description) if self.description and self.barcode_kit else dict()
+
+    def qc_key(self, fastq):
+        return StageCache.make_key(fastq=StageCache.fingerprint(fastq))
+
+    def filter_key(self, sample, fastq):
+        return StageCache.make_key(fastq=StageCache.fingerprint(fastq), engine=self.filter_engine, keep_percent=95,
+                                   target_bases=self.target(sample), gzi=self.gzi)
+
+    def qc_report_key(self, qc_folder):
+        partitions = glob(qc_folder + 'summary/*')
+        return StageCache.make_key(engine=self.qc_engine,
+                                   partitions={os.path.basename(x): StageCache.fingerprint(x) for x in partitions})
+
+    def qc_outputs(self, qc_folder):
+        if self.qc_engine == 'pycoQC':
+            return [qc_folder + 'sequencing_summary.txt', qc_folder + 'pycoQC_output.html']
+        return [qc_folder + 'qc_report.json', qc_folder + 'qc_report.html']
+
+    def filter_outputs(self, filtered_folder, sample):
+        filtered_fastq = filtered_folder + sample + '.fastq.gz'
+        return [filtered_fastq, filtered_fastq + '.gzi'] if self.gzi else [filtered_fastq]
+
+    def check_cache(self):
+        # Basecalling is all or nothing: the chunks are merged once done, so other basecalling settings or raw files
+        # mean starting over. Sample names are checked per sample (see "relabel_samples"), QC and filtering per fastq
+        # (see "stale_tasks").
+        self.basecall_key = self.basecalling_key()
+        self.migrate_flags()
+        entry = self.cache.entry('basecalling', 'run')
+        raw = StageCache.raw_digest(InventoryMethods.raw_files(self.inventory))
+        if entry and (entry['key'] != self.basecall_key or (entry['done'] and entry['raw'] != raw)):
+            self.start_over('Basecalling settings or raw files changed since the previous run')
+            entry = None
+        elif entry and entry['done'] and not self.relabel_samples(entry):
+            self.start_over('Barcodes deleted by the previous run are now in the description file')
+            entry = None
+        self.do_basecall = not (entry and entry['done'])
+
+    def migrate_flags(self):
+        # Output folder of an older version, with "done_*" files instead of the cache. The results they stand for are
+        # recorded with the current settings (when their outputs are there), then the files are removed.
+        flags = {x: self.output_folder + '/' + x for x in ['done_basecalling', 'done_QC', 'done_filtering']}
+        done = {x for x, flag in flags.items() if os.path.exists(flag)}
+        if not done:
+            return
+        if 'done_basecalling' in done and self.cache.entry('basecalling', 'run') is None:
+            self.cache.record('basecalling', 'run', self.basecall_key, [], done=True,
+                              raw=StageCache.raw_digest(InventoryMethods.raw_files(self.inventory)),
+                              samples=self.sample_names(), dropped=list())
+            basecalled_folder = self.output_folder + '/1_basecalled/'
+            qc_folder = self.output_folder + '/2_qc/'
+            for barcode in Methods.list_barcodes(basecalled_folder, self.barcode_kit):
+                for i in ['pass', 'fail']:
+                    fastq = Methods.barcode_fastq(basecalled_folder, barcode, i)
+                    if not os.path.exists(fastq):
+                        continue
+                    outputs = Methods.summary_files(fastq, qc_folder)
+                    if 'done_QC' in done and all(os.path.exists(x) for x in outputs):
+                        self.cache.record('qc', os.path.relpath(fastq, basecalled_folder), self.qc_key(fastq),
+                                          outputs)
+                    sample = barcode if barcode else i
+                    outputs = self.filter_outputs(self.output_folder + '/3_filtered/', sample)
+                    if 'done_filtering' in done and i == 'pass' and barcode != 'unclassified' \
+                            and all(os.path.exists(x) for x in outputs):
+                        self.cache.record('filter', sample, self.filter_key(sample, fastq), outputs)
+            outputs = self.qc_outputs(qc_folder)
+            if 'done_QC' in done and all(os.path.exists(x) for x in outputs):
+                self.cache.record('qc_report', 'run', self.qc_report_key(qc_folder), outputs)
+        for flag in flags.values():
+            if os.path.exists(flag):
+                os.remove(flag)
+
+    def relabel_samples(self, entry):
+        # Sample names changed in the description file since the previous run: rename the samples concerned and
+        # drop their QC and filtering results, delete the barcodes no longer listed. Returns False when a barcode
+        # deleted by the previous run is listed again, its reads are gone.
+        if not self.barcode_kit:
+            return True
+        samples = self.sample_names()
+        previous = entry.get('samples', dict())
+        dropped = entry.get('dropped', list())
+        if any(not samples or barcode in samples for barcode in dropped):
+            return False
+
+        barcodes = {name: barcode for barcode, name in previous.items()}  # Current folder name -> barcode
+        changes = dict()  # Current name -> new name, None to delete
+        for name in Methods.list_barcodes(self.output_folder + '/1_basecalled/', self.barcode_kit):
+            barcode = barcodes.get(name, name)
+            if barcode == 'unclassified':
+                continue
+            new_name = samples.get(barcode) if samples else barcode
+            if new_name != name:
+                changes[name] = new_name
+        if not changes:
+            return True
+
+        for folder in {self.work_folder, self.output_folder}:
+            Methods.relabel_samples(folder + '/1_basecalled/', folder + '/2_qc/', folder + '/3_filtered/', changes)
+        for name, new_name in sorted(changes.items()):
+            print('\tSample {} {}'.format(name, 'renamed to ' + new_name if new_name
+                                          else 'not in the description file anymore, deleted'))
+            for i in ['pass', 'fail']:
+                self.cache.drop('qc', os.path.join(i, name, name + '_' + i + '.fastq.gz'))
+            self.cache.drop('filter', name)
+        dropped = dropped + [barcodes.get(name, name) for name, new_name in changes.items() if new_name is None]
+        self.cache.record('basecalling', 'run', entry['key'], [], done=True, raw=entry['raw'], samples=samples,
+                          dropped=dropped)
+        return True
+
+    def start_over(self, reason):
+        # The previous outputs are moved aside rather than deleted, in case of a mistake in the options
+        backup = self.output_folder + '/previous_' + time.strftime('%Y%m%d_%H%M%S') + '/'
+        print('\t{}, starting over. Previous outputs moved to {}'.format(reason, backup))
+        for sub_folder in ['1_basecalled', '2_qc', '3_filtered']:
+            if os.path.exists(self.output_folder + '/' + sub_folder):
+                Methods.make_folder(backup)
+                os.rename(self.output_folder + '/' + sub_folder, backup + sub_folder)
+            if self.scratch:
+                shutil.rmtree(self.work_folder + '/' + sub_folder, ignore_errors=True)  # Scratch copies
+        self.cache.clear()
+
+    def stale_tasks(self, basecalled_folder, barcode, count=False):
+        # QC summaries and filtering left to do for one barcode (or sample): (stage, name, key, fastq, sample) tuples
+        tasks = list()
+        for i in ['pass', 'fail']:
+            fastq = Methods.barcode_fastq(basecalled_folder, barcode, i)
+            if not os.path.exists(fastq):
+                continue
+            tasks.append(('qc', os.path.relpath(fastq, basecalled_folder), self.qc_key(fastq), fastq, None))
+            if i == 'pass' and barcode != 'unclassified':
+                sample = barcode if barcode else i
+                tasks.append(('filter', sample, self.filter_key(sample, fastq), fastq, sample))
+        return [task for task in tasks if not self.cache.is_valid(task[0], task[1], task[2], count)]
+
+    def up_to_date(self):
+        # Nothing left to merge, QC or filter. Checked in the output folder, the scratch copy may be gone.
+        basecalled_folder = self.output_folder + '/1_basecalled/'
+        if any(self.stale_tasks(basecalled_folder, barcode)
+               for barcode in Methods.list_barcodes(basecalled_folder, self.barcode_kit)):
+            return False
+        return self.cache.is_valid('qc_report', 'run', self.qc_report_key(self.output_folder + '/2_qc/'))
+
+    def record_when_done(self, job, stage, name, key, outputs):
+        # Cache the result once its job succeeded, and copy its outputs to the output folder (with "--scratch")
+        def done(finished_job):
+            if not finished_job.cancelled() and finished_job.exception() is None:
+                self.cache.record(stage, name, key, outputs)
+                self.write_back.submit(*outputs)
+
+        job.add_done_callback(done)
+
+    def process_barcode(self, scheduler, barcode, description_dict, basecalled_folder, qc_folder, filtered_folder,
+                        do_merge):
+        # Merge and rename one barcode, then queue the QC summary and filtering jobs whose cached result is missing
+        # or stale. Returns the summary jobs.
+        from index_methods import IndexMethods  # NumPy, only loaded once there is something to process
+        summary_jobs = list()
+        if do_merge:
+            Methods.merge_barcode(basecalled_folder, barcode)
+            if barcode and description_dict:
+                name = Methods.rename_one_barcode(description_dict, basecalled_folder, barcode)
+                if not name:
+                    self.dropped.append(barcode)  # Not in the description file, deleted
+                    return summary_jobs
+                barcode = name
+
+            for i in ['pass', 'fail']:
+                fastq = Methods.barcode_fastq(basecalled_folder, barcode, i)
+                if os.path.exists(fastq):
+                    if self.watch and IndexMethods.load_index(fastq) is None:
+                        # Watch mode appends the reads in place, there were no chunks to index while merging
+                        IndexMethods.save_index(IndexMethods.index_records(fastq)[0], fastq)
+                    # Copied to the output folder (with "--scratch") while QC and filtering go on
+                    self.basecalled_copies.extend(self.write_back.submit(fastq, IndexMethods.index_file(fastq)))
+
+        for stage, name, key, fastq, sample in self.stale_tasks(basecalled_folder, barcode, count=True):
+            size = JobSizing.file_size(fastq)
+            if stage == 'qc':
+                job = scheduler.submit(Methods.summarize_fastq, fastq, qc_folder, process=True,
+                                       mem=JobSizing.summary_job(size), size=size)
+                self.record_when_done(job, stage, name, key, Methods.summary_files(fastq, qc_folder))
+                summary_jobs.append(job)
+            else:
+                self.submit_filter(scheduler, sample, fastq, filtered_folder, key)
+        return summary_jobs
 
-    def run(self):
+    def finish_qc(self, qc_folder):
+        # Summaries are done, gather them
+        if self.qc_engine == 'pycoQC':
+            print('Performing read QC with PycoQC...')
+            summary_file = Methods.write_seq_summary_tsv(qc_folder)
+            Methods.run_pycoQC(summary_file, qc_folder, 'pycoQC')
+        else:
+            Methods.run_qc_report(qc_folder)
+
+    def submit_filter(self, scheduler, sample, fastq, filtered_folder, key):
+        # Threads and memory follow the sample size. The scheduler starts the biggest samples first.
+        Methods.make_folder(filtered_folder)
+        size = JobSizing.file_size(fastq)
+        threads, mem = JobSizing.filter_job(size, self.cpu, self.buffer_size)
+        target_bases = self.target(sample)
+        if self.filter_engine == 'filtlong':
+            job = scheduler.submit(Methods.run_filtlong, sample, fastq, filtered_folder, 'nbc', threads,
+                                   self.buffer_size, self.gzi, target_bases, cpus=threads, mem=mem, size=size,
+                                   group='filter')
+        else:
+            job = scheduler.submit(Methods.run_read_filter, sample, fastq, filtered_folder, 95, threads,
+                                   self.buffer_size, self.gzi, target_bases, cpus=threads, mem=mem, size=size,
+                                   group='filter', process=True)
 
-        ##################
-        #
-        # Checks
-        #
-        ##################
+        self.record_when_done(job, 'filter', sample, key, self.filter_outputs(filtered_folder, sample))
 
+    def prepare(self):
         print('Checking a few things...')
 
         # Check if number of CPU and memory requested are valid
@@ -67,44 +341,205 @@ class Basecaller(object):
 
         # Check I/O
         Methods.check_input_folder(self.input)
-        Methods.check_raw_exist(self.input)
+        Methods.make_folder(self.output_folder)
+        Methods.make_folder(self.work_folder)
+
+        # Timing and resource usage of each stage, for QA and for comparing settings between runs
+        self.report = RunReport(self.output_folder + '/run_report.json',
+                                {'threads': self.cpu, 'parallel': self.parallel, 'memory_gb': self.mem,
+                                 'buffer_size_mb': self.buffer_size, 'gzi': self.gzi, 'batch_size': self.batch_size,
+                                 'prefetch': self.prefetch, 'prefetch_size_gb': self.prefetch_size,
+                                 'gpu': self.gpu, 'port': self.port, 'config': self.config,
+                                 'barcode_kit': self.barcode_kit, 'min_qscore': self.min_qscore,
+                                 'qc_engine': self.qc_engine, 'filter_engine': self.filter_engine,
+                                 'genome_size': self.genome_size, 'depth': self.depth, 'watch': self.watch,
+                                 'scratch': self.work_folder if self.scratch else None})
+
+    def check_inputs(self):
+        # List the raw files once. The inventory is kept in the output folder and only refreshed for the folders
+        # that changed since the previous invocation.
+        self.inventory = InventoryMethods.get_inventory(self.input, self.recursive, self.inventory_file)
+        if not self.watch:  # Raw files may not be there yet in watch mode
+            Methods.check_raw_inventory(self.inventory['files'])
         Methods.check_config(self.config, self.flowcell, self.sequencer, self.library_kit)
         if self.barcode_kit:
             Methods.check_barcode(self.barcode_kit, self.description)
+        if self.scratch:
+            cache_bytes = self.prefetch_size * 1000000000 if self.prefetch else 0
+            StagingMethods.check_free_space(InventoryMethods.total_size(self.inventory), self.work_folder,
+                                            self.output_folder, cache_bytes)
+        self.targets = {None: Methods.target_bases(self.genome_size, self.depth)}
+        if self.description:
+            self.targets.update(Methods.parse_targets(self.description, self.genome_size, self.depth))
+        self.check_cache()
+
+    def check_software(self):
+        # Returns the versions, for the run report
+        dorado_version = Methods.check_dorado_installed()
+
+        # Check environments, only for the external tools that will be used. Conda is only needed for them.
+        env_tools = list()
+        if self.qc_engine == 'pycoQC':
+            env_tools.append(('pycoQC', 'pycoQC'))
+        if self.filter_engine == 'filtlong':
+            env_tools.append(('nbc', 'filtlong'))
+        if env_tools:
+            Methods.check_conda_installed()
+
+        if self.qc_engine == 'pycoQC':
+            if not CondaMethods.is_conda_env_installed('pycoQC'):
+                CondaMethods.install_pycoQC_env()
+            self.pycoQC_env_path = CondaMethods.get_conda_env_path('pycoQC')
+
+        if self.filter_engine == 'filtlong':
+            if not CondaMethods.is_conda_env_installed('nbc'):
+                CondaMethods.install_nbc_env()
+            self.nbc_env_path = CondaMethods.get_conda_env_path('nbc')
+
+        versions = Methods.check_version(env_tools)
+        versions.update({'dorado': dorado_version, 'pipeline': __version__})
+        return versions
+
+    def get_config(self):
+        # Retrieve proper configuration file
+        if not self.config:
+            return Methods.get_dorado_config(self.flowcell, self.library_kit, self.sequencer, self.workflows)
+        return self.config
+
+    def start_servers(self, dorado_conf, port, keep):
+        # One server per device. Reuse the ones already running with the same config (see "--keep-server").
+        servers = ShardMethods.parse_servers(self.gpu, port)
+        print('Starting basecalling server...')
+        server_list = [ServerMethods.get_server(self.basecalled_folder, dorado_conf, port, device,
+                                                self.server_timeout, keep)
+                       for device, port in servers]
+        return servers, server_list
+
+    def basecall(self, dorado_conf, servers, stage):
+        # Settings recorded first, a resumed run with other ones starts over (see "check_cache")
+        self.cache.record('basecalling', 'run', self.basecall_key, [], done=False)
+        ledger_file = self.ledger_file
+
+        if self.watch:
+            print('Basecalling with Dorado as raw files are produced')
+            device, port = servers[0]
+            WatchMethods.watch(self.input, self.basecalled_folder, dorado_conf, self.recursive, device,
+                               self.barcode_kit, self.min_qscore, port,
+                               self.poll_interval, self.watch_timeout, self.batch_size, ledger_file,
+                               self.inventory_file)
+        else:
+            print('Basecalling with Dorado on {} device(s)'.format(len(servers)))
+            raw_files = InventoryMethods.raw_files(self.inventory)
+            todo = LedgerMethods.pending(raw_files, LedgerMethods.load(ledger_file))
+            if len(todo) < len(raw_files):
+                print('\tResuming: {} of {} raw files already basecalled'.format(len(raw_files) - len(todo),
+                                                                                len(raw_files)))
+            totals = ShardMethods.run_shards(todo, servers, self.basecalled_folder, dorado_conf, self.recursive,
+                                             self.barcode_kit, self.min_qscore, ledger_file, self.batch_size,
+                                             self.work_folder + '/prefetch/', self.prefetch,
+                                             self.prefetch_size * 1000000000)
+            stage.update({'raw_files': len(todo), 'raw_bytes': sum(size for size, _ in todo.values())})
+            stage.update(totals)
+            if 'prefetch' in totals:
+                print('	Prefetch: {hits} of {shards} shards ready in time, {stalls} stalls ({stall_seconds} s '
+                      'waiting)'.format(**totals['prefetch']))
+
+    def process(self):
+        # Each barcode goes through merge -> rename -> QC summary + filtering on its own, so QC and filtering of a
+        # sample start as soon as its merged fastq exists. All tasks share the "--threads" budget. Summaries and
+        # filtered fastq whose cached result is still valid are not computed again.
+        do_merge = self.do_basecall
+        if not do_merge and self.up_to_date():
+            print('Skipping merging, QC and filtering. Already done.')
+        else:
+            with self.report.stage('merge_qc_filter') as stage:
+                if self.scratch and not do_merge:
+                    # Resumed run: the merged fastq and summaries may only be left in the output folder
+                    StagingMethods.stage_in(self.output_folder, self.work_folder,
+                                            ['1_basecalled/pass/**/*', '1_basecalled/fail/**/*', '2_qc/summary/*'])
+                print('Merging, QC and filtering...')
+                description_dict = Methods.parse_samples(self.description) if self.description else dict()
+                scheduler = StageScheduler(self.cpu, self.mem * 1000000000, limits={'filter': self.parallel})
+                self.write_back = WriteBack(self.work_folder, self.output_folder)
+                self.basecalled_copies = list()
+                self.dropped = list()
+                qc_job = None
+                try:
+                    try:
+                        barcode_jobs = [scheduler.submit(self.process_barcode, scheduler, barcode, description_dict,
+                                                         self.basecalled_folder, self.qc_folder,
+                                                         self.filtered_folder, do_merge)
+                                        for barcode in Methods.list_barcodes(self.basecalled_folder,
+                                                                             self.barcode_kit)]
+                        summary_jobs = [job for barcode_job in barcode_jobs for job in barcode_job.result()]
+                        if do_merge:
+                            self.write_back.wait(self.basecalled_copies)
+                            self.cache.record('basecalling', 'run', self.basecall_key, [], done=True,
+                                              raw=StageCache.raw_digest(LedgerMethods.load(self.ledger_file)),
+                                              samples=self.sample_names(), dropped=sorted(self.dropped))
+
+                        # The QC report only needs the summaries, so it runs while the filtering jobs are still going
+                        for job in summary_jobs:
+                            job.result()
+                        report_key = self.qc_report_key(self.qc_folder)
+                        if not self.cache.is_valid('qc_report', 'run', report_key, count=True):
+                            qc_job = scheduler.submit(self.finish_qc, self.qc_folder)
+                            self.record_when_done(qc_job, 'qc_report', 'run', report_key,
+                                                  self.qc_outputs(self.qc_folder))
+                        scheduler.wait()
+                    finally:
+                        self.report.sample()  # Pool workers' usage, before they exit
+                        scheduler.shutdown()
+
+                    # Logs, once everything else is done
+                    for logs in [self.basecalled_folder + 'logs', self.qc_folder + 'logs',
+                                 self.filtered_folder + 'logs']:
+                        self.write_back.submit_folder(logs)
+                    self.write_back.wait()
+                finally:
+                    self.write_back.shutdown()
+                stage['tasks'] = scheduler.stats
+                stage['cache'] = self.cache.stats
+                if self.write_back.enabled:
+                    stage['write_back'] = self.write_back.stats
+                if self.cache.stats:
+                    print('\t' + ', '.join('{}: {} reused, {} computed'.format(name, x['reused'], x['computed'])
+                                           for name, x in self.cache.stats.items()))
+                if qc_job and os.path.exists(self.qc_folder + 'qc_report.json'):
+                    with open(self.qc_folder + 'qc_report.json', 'r') as f:
+                        qc_report = json.load(f)
+                    stage.update({'reads': qc_report['reads'], 'bases': qc_report['bases']})
+                elif do_merge:
+                    # No QC report (e.g. pycoQC), the sidecar indexes have the numbers
+                    stage.update(Methods.index_stats(self.basecalled_folder))
+
+        # Update sample_dict after extracting, only keep "pass" files. Paths are in the output folder.
+        self.sample_dict['basecalled'] = Methods.get_files(self.output_folder + '/1_basecalled/', 'pass.fastq.gz')
 
-        # Check software
-        Methods.check_dorado_installed()
-        Methods.check_conda_installed()
+        # Remove "unclassified" for next step if barcodes used
+        if self.barcode_kit:
+            self.sample_dict['basecalled'].pop('unclassified', None)
 
-        # Check environments
-        if not CondaMethods.is_conda_env_installed('pycoQC'):
-            CondaMethods.install_pycoQC_env()
-        self.pycoQC_env_path = CondaMethods.get_conda_env_path('pycoQC')
+        # Update sample_dict after trimming
+        self.sample_dict['filtered'] = Methods.get_files(self.output_folder + '/3_filtered/', '.fastq.gz')
 
-        if not CondaMethods.is_conda_env_installed('nbc'):
-            CondaMethods.install_nbc_env()
-        self.pycoQC_env_path = CondaMethods.get_conda_env_path('nbc')
+        # Everything is in the output folder now
+        if self.scratch:
+            shutil.rmtree(self.work_folder, ignore_errors=True)
 
-        print('\tAll checks passed')
+    def run(self):
 
         ##################
         #
-        # Preparing outputs
+        # Checks
         #
         ##################
 
-        # Step completion report files
-        done_basecalling = self.output_folder + '/done_basecalling'
-        done_qc = self.output_folder + '/done_QC'
-        done_filtering = self.output_folder + '/done_filtering'
-
-        # Output folders to create
-        basecalled_folder = self.output_folder + '/1_basecalled/'
-        qc_folder = self.output_folder + '/2_qc/'
-        filtered_folder = self.output_folder + '/3_filtered/'
-
-        # Create output folder
-        Methods.make_folder(self.output_folder)
+        self.prepare()
+        with self.report.stage('checks'):
+            self.check_inputs()
+            self.report.add_versions(self.check_software())
+            print('\tAll checks passed')
 
         ##################
         #
@@ -112,80 +547,127 @@ class Basecaller(object):
         #
         ##################
 
-        if not os.path.exists(done_basecalling):
-            # Retrieve proper configuration file
-            if not self.config:
-                dorado_conf = Methods.get_dorado_config(self.flowcell, self.library_kit, self.sequencer, self.workflows)
+        try:
+            if self.do_basecall:
+                with self.report.stage('basecalling') as stage:
+                    dorado_conf = self.get_config()
+                    servers, server_list = self.start_servers(dorado_conf, self.port, self.keep_server)
+                    try:
+                        self.basecall(dorado_conf, servers, stage)
+                    finally:
+                        # Terminate the basecalling servers, unless asked to keep them for the next run
+                        for server in server_list:
+                            ServerMethods.release_server(server, self.keep_server)
             else:
-                dorado_conf = self.config
-
-            # Basecall
-            # Methods.is_basecall_server_running()
-            print('Starting basecalling server...')
-            p = Methods.start_dorado_basecall_server(basecalled_folder, self.config, self.port, self.gpu)
+                print('Skipping basecalling. Already done.')
 
-            print('Basecalling with Dorado')
-            Methods.run_dorado(self.input, basecalled_folder, dorado_conf, self.recursive,
-                               self.gpu, self.barcode_kit, self.min_qscore, self.port)
-            # Terminate the basecalling server
-            p.terminate()
+            ##################
+            #
+            # 2- Merging, QC and filtering, per sample
+            #
+            ##################
 
-            # Merge all fastq per barcode, if more than one file present
-            Methods.merge_rename_fastq(basecalled_folder, self.barcode_kit)
-
-            if self.description:
-                sample_dict = Methods.parse_samples(self.description)
-                Methods.rename_barcode(sample_dict, basecalled_folder)  # Also remove extra barcode folders
-
-            # Create "done" file for resuming purposes
-            Methods.flag_done(done_basecalling)
-        else:
-            print('Skipping basecalling. Already done.')
-
-        # Update sample_dict after extracting, only keep "pass" files
-        self.sample_dict['basecalled'] = Methods.get_files(basecalled_folder, 'pass.fastq.gz')
-
-        # Remove "unclassified" for next step if barcodes used
-        if self.barcode_kit:
-            self.sample_dict['basecalled'].pop('unclassified')
+            self.process()
+        except BaseException:
+            # Error or Ctrl-C: stop the clients and tools still running instead of leaving them behind
+            ProcessManager.cancel_all()
+            raise
 
         ##################
         #
-        # 2- QC
+        # Done
         #
         ##################
 
-        if not os.path.exists(done_qc):
-            print('Performing read QC with PycoQC...')
-            Methods.fastq_to_seq_summary(basecalled_folder, qc_folder, self.cpu, 'pycoQC')
-            Methods.run_pycoQC(basecalled_folder, qc_folder)
-            Methods.flag_done(done_qc)
-        else:
-            print('Skipping QC. Already done.')
+        print('DONE!')
 
-        ##################
-        #
-        # 3- Filter reads
-        #
-        ##################
 
-        # Get reference size
-        if not os.path.exists(done_filtering):
-            print('Filtering lower quality reads with Filtlong...')
-            Methods.run_filtlong_parallel(self.sample_dict['basecalled'], filtered_folder, self.parallel, 'nbc')
-            Methods.flag_done(done_filtering)
-        else:
-            print('Skipping filtering. Already done.')
+class BatchBasecaller(object):
+    # Several runs (one manifest row each) in a single invocation. Software is checked once, servers are started
+    # once per config and kept for the whole batch, and the GPU basecalls run N+1 while the merging, QC and filtering
+    # of run N go on in the background.
+    manifest_columns = ['input', 'output', 'config', 'flowcell', 'library_kit', 'barcode_kit', 'description',
+                        'sequencer', 'genome_size', 'depth']
 
-        # Update sample_dict after trimming
-        self.sample_dict['filtered'] = Methods.get_files(filtered_folder, '.fastq.gz')
+    def __init__(self, args):
+        self.args = args
+        self.manifest = args.manifest
+        self.keep_server = args.keep_server
 
-        ##################
-        #
-        # Done
-        #
-        ##################
+        # Run
+        self.run()
 
+    def run_args(self, row):
+        # Command line options, overridden by the non-empty manifest columns
+        run_args = copy.copy(self.args)
+        for column in BatchBasecaller.manifest_columns:
+            if row.get(column):
+                setattr(run_args, column, row[column])
+        if row.get('barcode_kit'):
+            run_args.barcode_kit = [row['barcode_kit']]
+        return run_args
+
+    def run(self):
+        rows = Methods.parse_manifest(self.manifest, BatchBasecaller.manifest_columns)
+        runs = [Basecaller(self.run_args(row), run=False) for row in rows]
+        print('Batch of {} runs'.format(len(runs)))
+
+        # Same software for all the runs
+        versions = runs[0].check_software()
+
+        servers_by_config = dict()  # config -> (servers, server_list)
+        port = self.args.port
+        failed = list()
+        jobs = list()
+        post_processing = futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            for i, basecaller in enumerate(runs):
+                print('\nRun {} of {}: {}'.format(i + 1, len(runs), basecaller.input))
+                try:
+                    basecaller.prepare()
+                    with basecaller.report.stage('checks'):
+                        basecaller.check_inputs()
+                        basecaller.report.add_versions(versions)
+                        print('\tAll checks passed')
+
+                    if basecaller.do_basecall:
+                        with basecaller.report.stage('basecalling') as stage:
+                            dorado_conf = basecaller.get_config()
+                            if dorado_conf not in servers_by_config:
+                                # The first config gets the ports given with "--port", the next ones consecutive
+                                # ports after the ones already in use
+                                servers_by_config[dorado_conf] = basecaller.start_servers(dorado_conf, port, True)
+                                port = str(max(p for _, p in servers_by_config[dorado_conf][0]) + 1)
+                            basecaller.basecall(dorado_conf, servers_by_config[dorado_conf][0], stage)
+                    else:
+                        print('Skipping basecalling. Already done.')
+                except Exception as e:
+                    print('Run {} failed: {}'.format(basecaller.input, e))
+                    failed.append(basecaller.input)
+                    continue
+
+                # The GPU moves on to the next run while this one is being merged, QC'ed and filtered
+                jobs.append((basecaller, post_processing.submit(basecaller.process)))
+
+            for basecaller, job in jobs:
+                try:
+                    job.result()
+                except Exception as e:
+                    print('Run {} failed: {}'.format(basecaller.input, e))
+                    failed.append(basecaller.input)
+        except BaseException:
+            ProcessManager.cancel_all()
+            raise
+        finally:
+            post_processing.shutdown(cancel_futures=True)
+            # Terminate the basecalling servers, unless asked to keep them for the next batch
+            for servers, server_list in servers_by_config.values():
+                for server in server_list:
+                    ServerMethods.release_server(server, self.keep_server)
+
+        if failed:
+            print('\n{} of {} runs failed:\n\t{}'.format(len(failed), len(runs), '\n\t'.join(failed)))
+            sys.exit(1)
         print('DONE!')
 
 
@@ -195,11 +677,19 @@ if __name__ == "__main__":
 
     parser = ArgumentParser(description='Basecall Nanopore raw data to fastq using Dorado Basecall Server.')
     parser.add_argument('-i', '--input', metavar='/path/to/input_folder/',
-                        required=True, type=str,
-                        help='Folder that contains the fast5 files. Mandatory.')
+                        required=False, type=str,
+                        help='Folder that contains the fast5 files. Mandatory, unless "--manifest" is used.')
     parser.add_argument('-o', '--output', metavar='/path/to/output_folder/',
-                        required=True, type=str,
-                        help='Folder to hold the result files. Mandatory.')
+                        required=False, type=str,
+                        help='Folder to hold the result files. Mandatory, unless "--manifest" is used.')
+    parser.add_argument('--manifest', metavar='/path/to/manifest.tsv',
+                        required=False, type=str,
+                        help='Tab-separated file to process several runs in one go, one run per line. The header '
+                             'names the columns: "input" and "output" (mandatory), "config", "flowcell", '
+                             '"library_kit", "barcode_kit", "description", "sequencer", "genome_size" and "depth" '
+                             '(optional, the command line values are used when missing or empty). Servers are kept '
+                             'for the whole batch and the next run is basecalled while the previous one is merged, '
+                             'QC\'ed and filtered. Optional.')
     parser.add_argument('-s', '--sequencer',
                         required=False, type=str,
                         choices=['minion', 'promethion'],
@@ -225,32 +715,116 @@ if __name__ == "__main__":
                         help='Tab-separated file with two columns with barcode assignments. '
                              'First column contains barcode names [barcode01, barcode02, etc.]. '
                              'Second column contains sample name. Avoid using special characters. '
-                             'Sample file in data folder. Optional.')
+                             'Optional third and fourth columns set the genome size and depth of each sample (see '
+                             '"--genome-size" and "--depth"). Sample file in data folder. Optional.')
     parser.add_argument('--min-qscore', type=int, default=10, required=False,
                         help='Minimum acceptable qscore for a read to be filtered into the PASS folder.	'
                              'Accepted values: [0 .. 30]. Default 10. Optional.')
-    parser.add_argument('--port', type=int, default=5555, required=False,
-                        help='Port for basecalling service. Default 5555. Optional.')
+    parser.add_argument('--port', type=str, default='5555', required=False,
+                        help='Port for basecalling service. When several GPU devices are used, either give one port '
+                             'per device separated by commas or the first port and the next ones will be used. '
+                             'Default 5555. Optional.')
+    parser.add_argument('--keep-server',
+                        action='store_true',
+                        help='Leave the basecall server(s) running after the run so the next run using the same '
+                             'config, device and port starts without reloading the model. A later run without this '
+                             'option reuses and then stops them. Optional.')
+    parser.add_argument('--server-timeout', metavar='600',
+                        required=False, type=int, default=600,
+                        help='Seconds to wait for a basecall server to accept connections. Default is 600. '
+                             'Optional.')
+    parser.add_argument('--tool-timeout', metavar='0',
+                        required=False, type=int, default=0,
+                        help='Minutes allowed to each basecall client, filtering or QC process before it is stopped '
+                             'and the run fails. 0 for no limit. Default is 0. Optional.')
     parser.add_argument('-r', '--recursive',
                         action='store_true',
                         help='Look for pod5 or fast5 recursively. Optional')
+    parser.add_argument('--qc-engine',
+                        required=False, type=str, default='native',
+                        choices=['native', 'pycoQC'],
+                        help='Read QC engine. "native" writes a lightweight HTML/JSON report in-process. "pycoQC" '
+                             'writes a "sequencing_summary.txt" and runs pycoQC on it. Default "native". Optional.')
+    parser.add_argument('--filter-engine',
+                        required=False, type=str, default='native',
+                        choices=['native', 'filtlong'],
+                        help='Read filtering engine. "native" runs in-process and does not need the "nbc" conda '
+                             'environment. "filtlong" uses the external binary. Default "native". Optional.')
+    parser.add_argument('--scratch', metavar='/local/scratch/',
+                        required=False, type=str,
+                        help='Fast local folder (e.g. NVMe) for the intermediate files: basecall client output, '
+                             'merging, QC and filtering. Outputs are copied back to the output folder, and checked, '
+                             'as soon as they are ready. The run\'s scratch folder is deleted at the end. Free space '
+                             'is checked on both sides before starting. Optional.')
+    parser.add_argument('--prefetch', metavar='2',
+                        required=False, type=int, default=0,
+                        help='Copy the raw files of the next N batches to local disk while the current ones are '
+                             'basecalled, for raw data on slow or network storage. Copies go to the "--scratch" '
+                             'folder if given, the output folder otherwise, and are deleted once basecalled. Not '
+                             'used in watch mode. 0 to read the raw files in place. Default is 0. Optional.')
+    parser.add_argument('--prefetch-size', metavar='50',
+                        required=False, type=int, default=50,
+                        help='Maximum disk space in GB used by the prefetched raw files. Batches are made small '
+                             'enough to fit. Default is 50. Optional.')
+    parser.add_argument('--genome-size', metavar='5m',
+                        required=False, type=str,
+                        help='Expected genome size, in bases ("k", "m" and "g" suffixes are accepted). With "--depth", '
+                             'filtering keeps the best reads up to genome size x depth bases. Can be set per sample in '
+                             'the description file. Optional.')
+    parser.add_argument('--depth', metavar='100',
+                        required=False, type=float,
+                        help='Target depth of coverage after filtering. Needs "--genome-size". Optional.')
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help='Basecall raw files as they are produced by a running sequencer. Stops once MinKNOW '
+                             'writes its "final_summary" file or when no new file appears for "--watch-timeout" '
+                             'minutes. Optional.')
+    parser.add_argument('--poll-interval', metavar='60',
+                        required=False, type=int, default=60,
+                        help='Seconds between two scans of the input folder in watch mode. Default is 60. Optional.')
+    parser.add_argument('--watch-timeout', metavar='60',
+                        required=False, type=int, default=60,
+                        help='Minutes without new raw file before stopping watch mode. Default is 60. Optional.')
+    parser.add_argument('--batch-size', metavar='100',
+                        required=False, type=int, default=100,
+                        help='Maximum number of raw files sent to the basecall server at once. Smaller batches '
+                             'lose less work when a run is interrupted and resumed. Default is 100. Optional.')
     parser.add_argument('-t', '--threads', metavar=str(max_cpu),
                         required=False, type=int, default=max_cpu,
                         help='Number of threads. Default is maximum available({}). Optional.'.format(max_cpu))
     parser.add_argument('-g', '--gpu', metavar='"cuda:0"',
                         required=False, type=str, default='auto',
-                        help='GPU device to use. Typically use "cuda:0". Default is "auto". Optional.')
+                        help='GPU device to use. Typically use "cuda:0". Separate several devices with commas '
+                             '("cuda:0,cuda:1") to run one basecall server per device and split the input between '
+                             'them. Default is "auto". Optional.')
     parser.add_argument('-p', '--parallel', metavar='2',
                         required=False, type=int, default=2,
-                        help='Number of samples to process in parallel for trimming and filtering. '
-                             'Default is 2. Optional.')
+                        help='Maximum number of samples filtered at the same time. The threads given to each '
+                             'sample depend on its size. Default is 2. Optional.')
     parser.add_argument('-m', '--memory', metavar=str(max_mem),
                         required=False, type=int, default=max_mem,
-                        help='Memory in GB. Default is 85%% of total memory ({}). Optional.'.format(max_mem))
+                        help='Memory in GB. Merging, QC and filtering jobs only start when their estimated memory '
+                             'fits. Default is 85%% of total memory ({}). Optional.'.format(max_mem))
+    parser.add_argument('--buffer-size', metavar='64',
+                        required=False, type=int, default=64,
+                        help='Maximum memory in MB used to buffer and compress the output of each sample being '
+                             'filtered. Default is 64. Optional.')
+    parser.add_argument('--gzi',
+                        action='store_true',
+                        help='Write a ".gzi" index next to each filtered fastq. Filtered fastq are always BGZF '
+                             'compressed, so tools like "samtools faidx" or "bgzip" can seek and decompress them in '
+                             'parallel. Optional.')
     parser.add_argument('-v', '--version', action='version',
                         version=f'{os.path.basename(__file__)}: version {__version__}')
 
     # Get the arguments into an object
     arguments = parser.parse_args()
 
-    Basecaller(arguments)
+    if arguments.manifest:
+        if arguments.watch:
+            parser.error('"--watch" cannot be used with "--manifest".')
+        BatchBasecaller(arguments)
+    else:
+        if not arguments.input or not arguments.output:
+            parser.error('"--input" and "--output" are required, unless "--manifest" is used.')
+        Basecaller(arguments)
@@ -1,16 +1,20 @@
 import subprocess
 import os
 import sys
-from concurrent import futures
+import socket
 import pathlib
 from psutil import virtual_memory
 from multiprocessing import cpu_count
-import gzip
 from glob import glob
 import shutil
-import pandas as pd
 from kits import Kits
 from conda_methods import CondaMethods
+from merge_methods import MergeMethods
+from compress_methods import CompressMethods
+from workflow_methods import WorkflowMethods
+from process_methods import ProcessManager, ClientProgress
+# NumPy based modules (filter_methods, summary_methods, qc_methods) are imported where used, so that "--help",
+# "--version" and resumed runs that skip those stages start fast.
 
 
 # mamba create -n nanopore -y -c bioconda \
@@ -18,16 +22,21 @@ from conda_methods import CondaMethods
 
 
 class Methods(object):
+    # Executables can be swapped for stand-ins (e.g. to test scheduling without a GPU)
+    server_bin = os.environ.get('DORADO_BASECALL_SERVER', 'dorado_basecall_server')
+    client_bin = os.environ.get('ONT_BASECALL_CLIENT', 'ont_basecall_client')
+    progress_frequency = 30  # Seconds between two progress reports of the basecall clients
+
     @staticmethod
     def check_requested_cpus(requested_cpu, n_proc):
         total_cpu = cpu_count()
 
-        if 1 > requested_cpu > total_cpu:
+        if requested_cpu < 1 or requested_cpu > total_cpu:
             requested_cpu = total_cpu
-            sys.stderr.write("Number of threads was set to {}".format(requested_cpu))
-        if 1 > n_proc > total_cpu:
-            n_proc = total_cpu
-            sys.stderr.write("Number of samples to parallel process was set to {}".format(total_cpu))
+            sys.stderr.write("Number of threads was set to {}\n".format(requested_cpu))
+        if n_proc < 1 or n_proc > requested_cpu:
+            n_proc = requested_cpu
+            sys.stderr.write("Number of samples to parallel process was set to {}\n".format(n_proc))
 
         return requested_cpu, n_proc
 
@@ -37,8 +46,8 @@ class Methods(object):
         if requested_mem:
             if requested_mem > max_mem:
                 requested_mem = max_mem
-                sys.stderr.write("Requested memory was set higher than available system memory ({})".format(max_mem))
-                sys.stderr.write("Memory was set to {}".format(requested_mem))
+                sys.stderr.write("Requested memory was set higher than available system memory ({})\n".format(max_mem))
+                sys.stderr.write("Memory was set to {}\n".format(requested_mem))
         else:
             requested_mem = max_mem
 
@@ -54,17 +63,14 @@ class Methods(object):
             raise Exception('Please select a folder as input.')
 
     @staticmethod
-    def check_raw_exist(input_folder):
-        # Check if input folder contains fast5
-        for root, directories, filenames in os.walk(input_folder):
-            for filename in filenames:
-                if filename.endswith(('.fast5', '.pod5')):  # accept a tuple or string
-                    return  # At least one fast5 file is present
-        raise Exception('No pod5 or fast5 files detected in the provided input folder.')
+    def check_raw_inventory(raw_files):
+        # At least one pod5 or fast5 file, from the raw file inventory
+        if not raw_files:
+            raise Exception('No pod5 or fast5 files detected in the provided input folder.')
 
     @staticmethod
     def check_dorado_installed():
-        cmd = ['dorado_basecall_server', '--version']
+        cmd = [Methods.server_bin, '--version']
         status = subprocess.getstatusoutput(' '.join(cmd))
         if status[0] != 0:
             raise Exception('dorado_basecall_server not found!')
@@ -74,6 +80,7 @@ class Methods(object):
             dorado_version = '.'.join(dorado_version.split('.')[1:4])
             dorado_version = dorado_version.split('+')[0]
             print('Dorado Basecall Service Software{}'.format(dorado_version))
+            return dorado_version.strip()
 
     @staticmethod
     def check_conda_installed():
@@ -84,24 +91,22 @@ class Methods(object):
     @staticmethod
     def check_from_list(my_category, my_item, my_list):
         if my_item not in my_list:
-            print('Please use of the following choice for {}: {}'.format(my_category, my_list))
+            print('Please use of the following choice for {}: {}'.format(my_category, sorted(my_list)))
             sys.exit()
 
     @staticmethod
-    def check_version(log_file):
-        # Not being used right now because versions are captured in the requirements.txt file
-        with open(log_file, 'w') as f:
-            # Python
-            p = subprocess.Popen(['python', '--version'])
-            stderr, stdout = p.communicate()
-
-            # Porechop
-            p = subprocess.Popen(['porechop', '--version'])
-            stderr, stdout = p.communicate()
-
-            # Filtlong
-            p = subprocess.Popen(['filtlong', '--version'])
-            stderr, stdout = p.communicate()
+    def check_version(env_tools):
+        # Versions of the external tools used, for the run report. env_tools is a list of (conda env, tool) tuples.
+        import numpy as np
+        versions = {'python': sys.version.split()[0], 'numpy': np.__version__}
+        for env, tool in env_tools:
+            try:
+                out = subprocess.run(CondaMethods.tool_cmd(env, tool) + ['--version'], capture_output=True,
+                                     env=CondaMethods.env_vars(env), timeout=60)
+                versions[tool] = (out.stdout or out.stderr).decode().strip().split('\n')[-1]
+            except (OSError, KeyError, subprocess.TimeoutExpired):
+                versions[tool] = 'unknown'
+        return versions
 
     @staticmethod
     def check_config(config, flowcell, sequencer, library_kit):
@@ -109,15 +114,15 @@ class Methods(object):
             raise Exception('Please chose a configuration file or a "library kit/flowcell/sequencer" combination, '
                             'not both.')
         if config:
-            if config not in Kits.configuration_file_list:
+            if config not in Kits.configuration_file_set:
                 raise Exception('Please use one of the following supported configuration file: {}'
                                 .format(Kits.configuration_file_list))
         if not config:
             if flowcell and library_kit and sequencer:
                 # Check flowcell
-                Methods.check_from_list('flowcell', flowcell, Kits.flowcell_list)
+                Methods.check_from_list('flowcell', flowcell, Kits.flowcell_set)
                 # Check library kit
-                Methods.check_from_list('library kit', library_kit, Kits.library_kit_list)
+                Methods.check_from_list('library kit', library_kit, Kits.library_kit_set)
             else:
                 raise Exception('Please make sure you are selection a library kit, a flowcell and a sequencer if '
                                 'you are not using a configuration file')
@@ -126,21 +131,18 @@ class Methods(object):
     def check_barcode(barcode_kit, barcode_description):
         for bc in barcode_kit:
             if bc:
-                Methods.check_from_list('barcoding kit', bc, Kits.barcoding_kit_list)
+                Methods.check_from_list('barcoding kit', bc, Kits.barcoding_kit_set)
 
     @staticmethod
     def get_dorado_config(flowcell, library, sequencer, workflows):
-        # Parse workflow.tsv to pandas df
-        df = pd.read_csv(workflows, sep='\t', header=0)
-
-        # Return the config (4th column) matching the requested flowcell, library, accuracy and sequencer
-        guppy_conf_list = df.loc[(df['flowcell'] == flowcell) & (df['kit'] == library), 'config_name'].values
-
-        if sequencer == 'promethion':
-            guppy_conf_list = [x for x in guppy_conf_list if 'prom' in x]  # Assume it will only return one...
+        # Return the config (4th column of workflow.tsv) matching the requested flowcell, library, accuracy and
+        # sequencer, from the compiled index
+        guppy_conf_list = WorkflowMethods.lookup(flowcell, library, sequencer, workflows)
 
         if len(guppy_conf_list) == 1:
             conf = guppy_conf_list[0]
+        elif not guppy_conf_list:
+            conf = ''
         else:
             raise Exception('More than one config file matching '
                             '{}, {} and {}'.format(flowcell, library, sequencer))
@@ -185,15 +187,10 @@ class Methods(object):
     def list_files_in_folder(folder, extension):
         return glob(folder + '/*' + extension)
 
-    @staticmethod
-    def flag_done(flag_file):
-        with open(flag_file, 'w') as f:
-            pass
-
     @staticmethod
     def gzipped_file_size(gzipped_file):
-        with gzip.open(gzipped_file, 'rb') as f:
-            return f.seek(0, whence=2)
+        # Without decompressing for BGZF outputs
+        return CompressMethods.gzipped_file_size(gzipped_file)
 
     @staticmethod
     def merge_files(file_list, merged_file):
@@ -208,23 +205,47 @@ class Methods(object):
             os.remove(f)
 
     @staticmethod
-    def merge_rename_fastq(fastq_folder, barcode_kit):
-        # List all folders
+    def list_barcodes(fastq_folder, barcode_kit):
+        # Barcode (or sample, once renamed) folders found in "pass" or "fail". None when not barcoding.
+        if not barcode_kit:
+            return [None]
+        barcodes = set()
         for i in ['pass', 'fail']:
-            if not barcode_kit:
-                fastq_list = glob(fastq_folder + i + '/fastq_runid_*.fastq.gz')
-                merged_fastq = fastq_folder + i + '/' + i + '.fastq.gz'
-                Methods.merge_files(fastq_list, merged_fastq)
-                Methods.delete_unmerged(fastq_list)
-            else:
-                # List directory (each barcode)
-                folder_list = glob(fastq_folder + i + '/*/')
-                for barcode_folder in folder_list:
-                    fastq_list = glob(barcode_folder + '/fastq_runid_*.fastq.gz')
-                    barcode_name = barcode_folder.split('/')[-2]
-                    merged_fastq = fastq_folder + i + '/' + barcode_name + '/' + barcode_name + '_' + i + '.fastq.gz'
-                    Methods.merge_files(fastq_list, merged_fastq)
-                    Methods.delete_unmerged(fastq_list)
+            barcodes.update(os.path.basename(os.path.normpath(x)) for x in glob(fastq_folder + i + '/*/'))
+        return sorted(barcodes)
+
+    @staticmethod
+    def barcode_fastq(fastq_folder, barcode, i):
+        # Merged fastq of a barcode (or sample) for "pass" or "fail"
+        if barcode is None:
+            return fastq_folder + i + '/' + i + '.fastq.gz'
+        return fastq_folder + i + '/' + barcode + '/' + barcode + '_' + i + '.fastq.gz'
+
+    @staticmethod
+    def merge_barcode(fastq_folder, barcode, index=True):
+        # Merge the pass and fail chunks of one barcode into a single fastq each, in their barcode folders
+        for i in ['pass', 'fail']:
+            merged_fastq = Methods.barcode_fastq(fastq_folder, barcode, i)
+            fastq_list = glob(os.path.dirname(merged_fastq) + '/fastq_runid_*.fastq.gz')
+            MergeMethods.merge_files_atomic(fastq_list, merged_fastq, index)
+
+    @staticmethod
+    def rename_fastq(fastq, new_fastq):
+        # The sidecar index follows its fastq
+        os.rename(fastq, new_fastq)
+        from index_methods import IndexMethods
+        IndexMethods.rename_index(fastq, new_fastq)
+
+    @staticmethod
+    def index_stats(basecalled_folder):
+        # Reads, bases and N50 of the merged fastq, from their sidecar indexes. Empty if one is missing.
+        import numpy as np
+        from index_methods import IndexMethods
+        from summary_methods import SummaryMethods
+        indexes = [IndexMethods.load_index(fastq) for fastq in SummaryMethods.list_merged_fastq(basecalled_folder)]
+        if not indexes or any(index is None for index in indexes):
+            return dict()
+        return IndexMethods.stats(np.concatenate(indexes))
 
     @staticmethod
     def parse_samples(barcode_desc):
@@ -235,61 +256,175 @@ class Methods(object):
                 line = line.rstrip()
                 if not line:
                     continue
-                try:
-                    barcode, sample_name = line.split('\t')
-                except IndexError:
+                fields = line.split('\t')
+                if len(fields) < 2:
                     raise Exception('The sample description file must be a tab-separated file with two columns where '
                                     'the first one is the barcode (e.g. barcode01) name and the second one the sample '
                                     'name (e.g. my_sample')
-                sample_dict[barcode] = sample_name
+                sample_dict[fields[0]] = fields[1]
 
         return sample_dict
 
     @staticmethod
-    def rename_barcode(sample_dict, basecalled_folder):
+    def parse_genome_size(genome_size):
+        # "5000000", "5m", "4.6Mb", "2.5 g" -> bases
+        value = str(genome_size).strip().lower().replace(' ', '')
+        for suffix in ['bp', 'b']:
+            if value.endswith(suffix):
+                value = value[:-len(suffix)]
+                break
+        multiplier = {'k': 1e3, 'm': 1e6, 'g': 1e9}.get(value[-1:], 1)
+        if multiplier != 1:
+            value = value[:-1]
+        try:
+            bases = int(float(value) * multiplier)
+        except ValueError:
+            raise Exception('Invalid genome size "{}". Use a number of bases, e.g. 5000000 or 5m.'.format(genome_size))
+        if bases <= 0:
+            raise Exception('The genome size must be greater than 0.')
+        return bases
+
+    @staticmethod
+    def target_bases(genome_size, depth):
+        # Bases to keep for a sample, None to keep "--keep_percent" only
+        if not genome_size or not depth:
+            return None
+        return int(Methods.parse_genome_size(genome_size) * float(depth))
+
+    @staticmethod
+    def parse_targets(barcode_desc, genome_size, depth):
+        # Optional third and fourth columns of the description file: genome size and depth of each sample. Empty or
+        # missing values fall back to "--genome-size" and "--depth". Returns sample name -> target bases.
+        targets = dict()
+        with open(barcode_desc, 'r') as f:
+            for line in f:
+                fields = [x.strip() for x in line.rstrip('\n').split('\t')]
+                if len(fields) < 2 or not fields[0]:
+                    continue
+                sample_genome_size = fields[2] if len(fields) > 2 and fields[2] else genome_size
+                sample_depth = fields[3] if len(fields) > 3 and fields[3] else depth
+                try:
+                    targets[fields[1]] = Methods.target_bases(sample_genome_size, sample_depth)
+                except ValueError:
+                    raise Exception('Invalid depth "{}" for sample {} in the description file.'.format(
+                        sample_depth, fields[1]))
+        return targets
+
+    @staticmethod
+    def parse_manifest(manifest, columns):
+        # Tab-separated, one run per line, with a header naming the columns. "input" and "output" are mandatory.
+        runs = list()
+        with open(manifest, 'r') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip() and not line.startswith('#')]
+        if not lines:
+            raise Exception('The manifest file is empty.')
+        header = [x.strip() for x in lines[0].split('\t')]
+        unknown = [x for x in header if x not in columns]
+        if unknown or 'input' not in header or 'output' not in header:
+            raise Exception('The manifest file must be a tab-separated file with a header line. "input" and "output" '
+                            'columns are mandatory, the others are optional: {}.'.format(', '.join(columns)))
+        for line in lines[1:]:
+            fields = [x.strip() for x in line.split('\t')]
+            run = dict(zip(header, fields))
+            if not run.get('input') or not run.get('output'):
+                raise Exception('Missing input or output folder in the manifest line: {}'.format(line))
+            runs.append(run)
+        outputs = [os.path.abspath(run['output']) for run in runs]
+        if len(set(outputs)) != len(outputs):
+            raise Exception('Each run of the manifest needs its own output folder.')
+        return runs
+
+    @staticmethod
+    def rename_one_barcode(sample_dict, basecalled_folder, barcode_name):
+        # Rename the pass and fail fastq of one barcode after its sample.
+        # Returns the new name, or None if the barcode was deleted.
+        if barcode_name == 'unclassified' or barcode_name in sample_dict.values():
+            return barcode_name  # Kept as is, or already renamed by a previous attempt
         for i in ['pass', 'fail']:
-            # Rename folders
-            folder_list = glob(basecalled_folder + i + '/*/')
-            for barcode_folder in folder_list:
-                barcode_name = barcode_folder.split('/')[-2]
-                if barcode_name in sample_dict:
-                    folder_new_name = '/'.join(barcode_folder.split('/')[:-2]) + '/' + sample_dict[barcode_name] + '/'
-                    fastq_current_name = folder_new_name + '/' + barcode_name + '_' + i + '.fastq.gz'
-                    fastq_new_name = folder_new_name + '/' + sample_dict[barcode_name] + '_' + i + '.fastq.gz'
-                    os.rename(barcode_folder, folder_new_name)  # Rename folder
-                    os.rename(fastq_current_name, fastq_new_name)  # Rename fastq
-                elif barcode_name == 'unclassified':
+            barcode_folder = basecalled_folder + i + '/' + barcode_name + '/'
+            if not os.path.isdir(barcode_folder):
+                continue
+            if barcode_name in sample_dict:
+                folder_new_name = basecalled_folder + i + '/' + sample_dict[barcode_name] + '/'
+                os.rename(barcode_folder, folder_new_name)  # Rename folder
+                Methods.rename_fastq(folder_new_name + barcode_name + '_' + i + '.fastq.gz',
+                                     Methods.barcode_fastq(basecalled_folder, sample_dict[barcode_name], i))
+            else:  # Delete barcodes found but not present en description file. Not supposed to be there
+                shutil.rmtree(barcode_folder, ignore_errors=False, onerror=None)  # Delete non-empty folder
+        return sample_dict.get(barcode_name)
+
+    @staticmethod
+    def relabel_samples(basecalled_folder, qc_folder, filtered_folder, changes):
+        # "changes" maps current sample (or barcode) names to new ones, None to delete the sample. The QC summaries
+        # and filtered fastq of these samples are deleted, they are made again under the new name.
+        for name in changes:
+            outputs = [filtered_folder + name + '.fastq.gz', filtered_folder + name + '.fastq.gz.gzi']
+            for i in ['pass', 'fail']:
+                outputs.extend(Methods.summary_files(Methods.barcode_fastq(basecalled_folder, name, i), qc_folder))
+            for path in outputs:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        # In two steps, so that two samples can swap names
+        for name, new_name in changes.items():
+            for i in ['pass', 'fail']:
+                barcode_folder = basecalled_folder + i + '/' + name + '/'
+                if not os.path.isdir(barcode_folder):
+                    continue
+                if new_name is None:
+                    shutil.rmtree(barcode_folder)
+                else:
+                    os.rename(barcode_folder, basecalled_folder + i + '/' + name + '.relabel/')
+        for name, new_name in changes.items():
+            for i in ['pass', 'fail']:
+                tmp_folder = basecalled_folder + i + '/' + name + '.relabel/'
+                if new_name is None or not os.path.isdir(tmp_folder):
                     continue
-                else:  # Delete barcodes found but not present en description file. Not supposed to be there
-                    shutil.rmtree(barcode_folder, ignore_errors=False, onerror=None)  # Delete non-empty folder
+                os.rename(tmp_folder, basecalled_folder + i + '/' + new_name + '/')
+                fastq = basecalled_folder + i + '/' + new_name + '/' + name + '_' + i + '.fastq.gz'
+                if os.path.exists(fastq):
+                    Methods.rename_fastq(fastq, Methods.barcode_fastq(basecalled_folder, new_name, i))
 
     @staticmethod
-    def is_basecall_server_running():
-        cmd = ['jobs']
-        # status = subprocess.getstatusoutput(' '.join(cmd))
-        result = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+    def is_basecall_server_running(port, host='127.0.0.1'):
+        # The server is ready once it accepts connections on its port
+        try:
+            with socket.create_connection((host, int(port)), timeout=1):
+                return True
+        except OSError:
+            return False
 
     @staticmethod
-    def start_dorado_basecall_server(basecalled_folder, config, port, gpu):
-        cmd = ['dorado_basecall_server',
+    def start_dorado_basecall_server(basecalled_folder, config, port, gpu, log_path=None, detach=False):
+        if not log_path:
+            log_path = basecalled_folder + '/logs/server_' + str(port)  # One log folder per server
+        cmd = [Methods.server_bin,
                '--config',  config,
                '--port', str(port),
-               '--log_path', basecalled_folder + '/logs',
+               '--log_path', log_path,
                '--device', gpu]
 
-        # Check if already running
         Methods.make_folder(basecalled_folder)
-        os.chdir(basecalled_folder)
-        p = subprocess.Popen(cmd)  # stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if detach:
+            # Own session so the server survives this process and keeps the model loaded for the next run
+            Methods.make_folder(log_path)
+            with open(log_path + '/stdout.txt', 'ab') as log:
+                p = subprocess.Popen(cmd, cwd=log_path, stdout=log, stderr=subprocess.STDOUT,
+                                     stdin=subprocess.DEVNULL, start_new_session=True)
+        else:
+            # Stopped with the run, output logged
+            p = ProcessManager.start(cmd, log_path + '/stdout.txt', cwd=basecalled_folder)
         return p
 
     @staticmethod
     def run_dorado(raw_folder, basecalled_folder, dorado_conf, recursive, gpu, barcode_kit,
-                   min_qscore, port):
+                   min_qscore, port, input_file_list=None, log_file=None, name='basecalling'):
+        # Returns the progress (reads and bases basecalled)
         Methods.make_folder(basecalled_folder)
-        os.chdir(basecalled_folder)  # avoid folders to be created in the script location
+        if not log_file:
+            log_file = basecalled_folder + 'logs/client.log'
 
-        cmd = ['ont_basecall_client',
+        cmd = [Methods.client_bin,
                '--port', str(port),
                '--config', dorado_conf,
                '--input_path', raw_folder,
@@ -303,9 +438,13 @@ class Methods(object):
                '--trim_adapters',
                '--trim_primers',
                '--detect_mid_strand_adapter',
+               '--progress_stats_frequency', str(Methods.progress_frequency),
                '--min_qscore', str(min_qscore)]
         if recursive:
             cmd += ['--recursive']
+        if input_file_list:
+            # Only basecall the files listed (file names, one per line) from the input folder
+            cmd += ['--input_file_list', input_file_list]
         if barcode_kit:
             cmd += ['--enable_trim_barcodes', '--detect_mid_strand_barcodes']
             if barcode_kit[0] != 'unknown':
@@ -314,7 +453,11 @@ class Methods(object):
                 else:
                     cmd += ['--barcode_kits', barcode_kit[0]]
 
-        subprocess.run(cmd)
+        # Run from the output folder to avoid folders to be created in the script location. Using "cwd" rather than
+        # "os.chdir" keeps it safe when several clients are started from different threads.
+        progress = ClientProgress(name)
+        ProcessManager.run(cmd, log_file, cwd=basecalled_folder, on_line=progress)
+        return progress
 
     @staticmethod
     def rename_basecalled(basecalled_folder, sample_dict):
@@ -351,48 +494,76 @@ class Methods(object):
         Methods.get_files(basecalled_folder)
 
     @staticmethod
-    def fastq_to_seq_summary(basecalled_folder, qc_folder, cpu, env):
-        print('Generating "seq_summary" file from fastq...')
-        Methods.make_folder(qc_folder)
+    def summarize_fastq(fastq, qc_folder):
+        # Summary partition of a single merged fastq
+        Methods.make_folder(qc_folder + 'summary/')
+        from summary_methods import SummaryMethods
+        SummaryMethods.summarize_fastq(fastq, qc_folder + 'summary/')
+
+    @staticmethod
+    def summary_files(fastq, qc_folder):
+        # Summary partition written by "summarize_fastq"
+        from summary_methods import SummaryMethods
+        partition = qc_folder + 'summary/' + SummaryMethods.partition_name(fastq)
+        return [partition + '.npy', partition + '.json']
 
-        conda_run = ['conda', 'run', '-n', env]
-        cmd = ['Fastq_to_seq_summary',
-               '-t', str(cpu),
-               '-f', basecalled_folder,
-               '-s', qc_folder + '/seq_summary_dorado.txt']
-        subprocess.run(conda_run + cmd)  # stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    @staticmethod
+    def write_seq_summary_tsv(qc_folder):
+        # Gather the summary partitions in the TSV pycoQC reads
+        summary_file = qc_folder + 'sequencing_summary.txt'
+        from summary_methods import SummaryMethods
+        SummaryMethods.write_tsv(qc_folder + 'summary/', summary_file)
+        return summary_file
 
     @staticmethod
-    def run_pycoQC(basecalled_folder, qc_folder, env):
+    def run_qc_report(qc_folder):
+        # Built-in alternative to pycoQC, reading the summary partitions chunk by chunk
+        print('Computing QC report...')
+        from qc_methods import QcMethods
+        QcMethods.make_report(qc_folder)
+
+    @staticmethod
+    def run_pycoQC(summary_file, qc_folder, env):
         print('')
         Methods.make_folder(qc_folder)
-        conda_run = ['conda', 'run', '-n', env]
-        cmd = ['pycoQC',
-               '-f', basecalled_folder + 'sequencing_summary.txt',
+        cmd = CondaMethods.tool_cmd(env, 'pycoQC') + [
+               '-f', summary_file,
                '-o', qc_folder + 'pycoQC_output.html']
 
-        subprocess.run(conda_run + cmd)  # stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        ProcessManager.run(cmd, qc_folder + 'logs/pycoQC.log', env=CondaMethods.env_vars(env))
 
     @staticmethod
-    def run_filtlong(sample, input_fastq, filtered_folder, env):
-        print('\t{}'.format(sample))
-        conda_run = ['conda', 'run', '-n', env]
-        cmd = ['filtlong',
-               '--keep_percent', str(95),  # Drop bottom 5% reads
-               input_fastq]
-
-        # Filtlong writes to stdout
+    def run_filtlong(sample, input_fastq, filtered_folder, env, threads, buffer_size, index=False, target_bases=None):
+        print('\t{}'.format(sample) + (' (target {} bases)'.format(target_bases) if target_bases else ''))
+        cmd = CondaMethods.tool_cmd(env, 'filtlong') + [
+               '--keep_percent', str(95)]  # Drop bottom 5% reads
+        if target_bases:
+            cmd += ['--target_bases', str(target_bases)]  # Best reads up to genome size x depth
+        cmd.append(input_fastq)
+
+        # Filtlong writes to stdout. Stream it in fixed-size chunks to a multi-threaded compressor so memory usage
+        # stays bounded by "buffer_size" (MB) instead of holding the whole uncompressed fastq.
         filtered_fastq = filtered_folder + sample + '.fastq.gz'
-        p = subprocess.Popen(conda_run + cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        with gzip.open(filtered_fastq, 'wb') as f:
-            f.write(p.communicate()[0])
+        block_size = CompressMethods.block_size_from_buffer(buffer_size, threads)
+        try:
+            ProcessManager.run_piped(cmd, filtered_folder + 'logs/' + sample + '_filtlong.log',
+                                     lambda stream: CompressMethods.stream_to_gzip(stream, filtered_fastq, threads,
+                                                                                   block_size, index),
+                                     env=CondaMethods.env_vars(env))
+        except BaseException:
+            # Do not leave a truncated output behind, it would look complete on resume
+            for f in [filtered_fastq, filtered_fastq + '.gzi']:
+                if os.path.exists(f):
+                    os.remove(f)
+            raise
 
     @staticmethod
-    def run_filtlong_parallel(sample_dict, output_folder, parallel, env):
-        Methods.make_folder(output_folder)
-
-        with futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
-            args = ((sample, path, output_folder, env)
-                    for sample, path in sample_dict.items())
-            for results in executor.map(lambda x: Methods.run_filtlong(*x), args):
-                pass
+    def run_read_filter(sample, input_fastq, filtered_folder, keep_percent, threads, buffer_size, index=False,
+                        target_bases=None):
+        # In-process equivalent of "filtlong --keep_percent [--target_bases]"
+        print('\t{}'.format(sample) + (' (target {} bases)'.format(target_bases) if target_bases else ''))
+        filtered_fastq = filtered_folder + sample + '.fastq.gz'
+        block_size = CompressMethods.block_size_from_buffer(buffer_size, threads)
+        from filter_methods import FilterMethods
+        FilterMethods.filter_fastq(input_fastq, filtered_fastq, keep_percent, threads, block_size, index,
+                                   target_bases)
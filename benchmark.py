@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import shutil
+from argparse import ArgumentParser, Namespace
+from multiprocessing import cpu_count
+from psutil import virtual_memory
+from benchmark_methods import BenchmarkMethods
+
+BenchmarkMethods.use_stubs()  # Before the pipeline modules read the executables location
+
+from basecall_nanopore_dorado_methods import Methods
+from inventory_methods import InventoryMethods
+from server_methods import ServerMethods
+from shard_methods import ShardMethods
+from summary_methods import SummaryMethods
+from report_methods import RunReport
+from basecall_nanopore_dorado import Basecaller
+
+
+__author__ = 'duceppemo'
+__version__ = '0.1'
+
+
+class Benchmark(object):
+    # One scenario per step of the per-sample pipeline, run one sample after the other, then the whole of it
+    # ("process": merging, renaming, QC and filtering of all the samples at once, as Basecaller.process runs them)
+    scenarios = ['merge_barcode', 'rename_one_barcode', 'get_files', 'summary', 'qc_report', 'filter', 'process',
+                 'basecall_stub']
+
+    def __init__(self, args):
+        # I/O
+        self.output_folder = os.path.abspath(args.output) + '/'
+        self.results_folder = os.path.abspath(args.results) + '/' if args.results \
+            else self.output_folder + 'results/'
+        self.baseline = args.baseline
+        self.tolerance = args.tolerance
+        self.keep = args.keep
+
+        # Synthetic run
+        self.barcodes = args.barcodes
+        self.chunks = args.chunks
+        self.reads_per_chunk = args.reads_per_chunk
+        self.mean_length = args.mean_length
+        self.skew = args.skew
+        self.raw_files = args.raw_files
+        self.prefetch = args.prefetch
+
+        # Performance
+        self.cpu = args.threads
+        self.parallel = args.parallel
+        self.buffer_size = args.buffer_size
+        self.repeat = args.repeat
+        self.selected = args.scenarios.split(',') if args.scenarios else Benchmark.scenarios
+
+        # Run
+        self.run()
+
+    def run(self):
+        source_folder = self.output_folder + 'source/'
+        work_folder = self.output_folder + 'work/'
+        basecalled_folder = work_folder + '1_basecalled/'
+        merged_folder = self.output_folder + 'merged/'
+        qc_folder = work_folder + '2_qc/'
+        filtered_folder = work_folder + '3_filtered/'
+        barcode_kit = ['SQK-NBD114-24'] if self.barcodes else None
+        sample_dict = {'barcode{:02d}'.format(i + 1): 'sample{:02d}'.format(i + 1) for i in range(self.barcodes)}
+        timings = dict()
+
+        print('Generating synthetic run...')
+        run_settings = {'barcodes': self.barcodes, 'chunks': self.chunks, 'reads_per_chunk': self.reads_per_chunk,
+                        'mean_length': self.mean_length, 'skew': self.skew}
+        settings = dict(run_settings, raw_files=self.raw_files, threads=self.cpu, parallel=self.parallel,
+                        buffer_size=self.buffer_size, prefetch=self.prefetch)
+        if os.path.exists(self.output_folder + 'source.json'):
+            with open(self.output_folder + 'source.json', 'r') as f:
+                source = json.load(f)
+        else:
+            source = None
+        if not source or source['settings'] != run_settings:
+            shutil.rmtree(source_folder, ignore_errors=True)
+            source = BenchmarkMethods.generate_run(source_folder, self.barcodes, self.chunks, self.reads_per_chunk,
+                                                   self.mean_length, self.skew)
+            source['settings'] = run_settings
+            with open(self.output_folder + 'source.json', 'w') as f:
+                json.dump(source, f)
+        print('\t{} reads, {} bases'.format(source['reads'], source['bases']))
+
+        def fresh_copy():
+            BenchmarkMethods.copy_tree(source_folder, basecalled_folder)
+
+        def merged_copy():
+            BenchmarkMethods.copy_tree(merged_folder, basecalled_folder)
+
+        # Each scenario starts from the state left by the previous ones. Merging is needed by all the others.
+        print('Running scenarios...')
+        fresh_copy()
+        barcodes = Methods.list_barcodes(basecalled_folder, barcode_kit)
+
+        def merge_all():
+            for barcode in barcodes:
+                Methods.merge_barcode(basecalled_folder, barcode)
+
+        if 'merge_barcode' in self.selected:
+            timings['merge_barcode'] = BenchmarkMethods.time_it(merge_all, repeat=self.repeat, setup=fresh_copy)
+        else:
+            merge_all()
+        BenchmarkMethods.copy_tree(basecalled_folder, merged_folder)
+
+        if barcode_kit:
+            def rename_all():
+                for barcode in barcodes:
+                    Methods.rename_one_barcode(sample_dict, basecalled_folder, barcode)
+
+            if 'rename_one_barcode' in self.selected:
+                timings['rename_one_barcode'] = BenchmarkMethods.time_it(rename_all, repeat=self.repeat,
+                                                                         setup=merged_copy)
+            else:
+                rename_all()
+
+        if 'get_files' in self.selected:
+            timings['get_files'] = BenchmarkMethods.time_it(Methods.get_files, basecalled_folder, 'pass.fastq.gz',
+                                                            repeat=self.repeat)
+        samples = Methods.get_files(basecalled_folder, 'pass.fastq.gz')
+        samples.pop('unclassified', None)
+
+        def summarize_all():
+            for fastq in SummaryMethods.list_merged_fastq(basecalled_folder):
+                Methods.summarize_fastq(fastq, qc_folder)
+
+        if 'summary' in self.selected or 'qc_report' in self.selected:
+            timings['summary'] = BenchmarkMethods.time_it(summarize_all, repeat=self.repeat)
+        if 'qc_report' in self.selected:
+            timings['qc_report'] = BenchmarkMethods.time_it(Methods.run_qc_report, qc_folder, repeat=self.repeat)
+
+        def filter_all():
+            Methods.make_folder(filtered_folder)
+            for sample, path in samples.items():
+                Methods.run_read_filter(sample, path, filtered_folder, 95, self.cpu, self.buffer_size)
+
+        if 'filter' in self.selected:
+            timings['filter'] = BenchmarkMethods.time_it(filter_all, repeat=self.repeat)
+
+        if 'process' in self.selected:
+            timings['process'] = self.process(source_folder, work_folder, barcode_kit, sample_dict)
+
+        if 'basecall_stub' in self.selected:
+            timings['basecall_stub'] = self.basecall_stub(work_folder, barcode_kit)
+
+        results = {'version': __version__,
+                   'machine': BenchmarkMethods.machine(),
+                   'settings': settings,
+                   'reads': source['reads'],
+                   'bases': source['bases'],
+                   'scenarios': timings}
+        results_file = BenchmarkMethods.save_results(results, self.results_folder)
+        print('Results written to {}'.format(results_file))
+        for name, seconds in timings.items():
+            print('\t{:<24}{:>10} s'.format(name, seconds))
+
+        if not self.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+            shutil.rmtree(merged_folder, ignore_errors=True)
+
+        if self.baseline:
+            regressions = BenchmarkMethods.compare(results, self.baseline, self.tolerance)
+            if regressions:
+                print('Slower than baseline: {}'.format(', '.join(regressions)))
+                sys.exit(1)
+
+    def process(self, source_folder, work_folder, barcode_kit, sample_dict):
+        # The pipeline's own merging, renaming, QC and filtering, all the samples sharing the StageScheduler
+        output_folder = work_folder + 'pipeline/'
+        description = work_folder + 'description.tsv'
+        with open(description, 'w') as f:
+            for barcode, sample in sample_dict.items():
+                f.write('{}\t{}\n'.format(barcode, sample))
+        args = Namespace(input=work_folder + 'raw/', output=output_folder, scratch=None, threads=self.cpu,
+                         parallel=self.parallel, memory=int(virtual_memory().total / 1e9),
+                         buffer_size=self.buffer_size, gzi=False, prefetch=0, prefetch_size=50, gpu='cpu',
+                         description=description if barcode_kit else None, barcode_kit=barcode_kit, sequencer=None,
+                         config='stub.cfg', flowcell=None, library_kit=None, min_qscore=10, port='5555',
+                         recursive=False, keep_server=False, server_timeout=600, tool_timeout=0, watch=False,
+                         poll_interval=60, watch_timeout=60, batch_size=100, filter_engine='native',
+                         genome_size=None, depth=None, qc_engine='native')
+
+        def setup():
+            shutil.rmtree(output_folder, ignore_errors=True)
+            BenchmarkMethods.copy_tree(source_folder, output_folder + '1_basecalled/')
+
+        def process():
+            basecaller = Basecaller(args, run=False)
+            basecaller.report = RunReport(output_folder + 'run_report.json', dict())
+            basecaller.targets = {None: None}
+            basecaller.process()
+
+        return BenchmarkMethods.time_it(process, repeat=self.repeat, setup=setup)
+
+    def basecall_stub(self, work_folder, barcode_kit):
+        # Server startup, sharding, client runs and collection of the chunks, with the stub executables
+        raw_folder = work_folder + 'raw/'
+        basecalled_folder = work_folder + 'stub_basecalled/'
+        shutil.rmtree(basecalled_folder, ignore_errors=True)
+        BenchmarkMethods.generate_raw(raw_folder, self.raw_files, 1000000)
+        inventory = InventoryMethods.get_inventory(raw_folder, False, work_folder + 'raw_inventory.json')
+        port = str(BenchmarkMethods.free_port())
+        servers = ShardMethods.parse_servers('cpu', port)
+
+        def basecall():
+            server = ServerMethods.get_server(basecalled_folder, 'stub.cfg', port, 'cpu', 60, False)
+            try:
+                ShardMethods.run_shards(InventoryMethods.raw_files(inventory), servers, basecalled_folder,
+                                        'stub.cfg', False, barcode_kit, 10, basecalled_folder + 'ledger.tsv', 100,
+                                        work_folder + 'prefetch/', self.prefetch, 50 * 1000000000)
+            finally:
+                ServerMethods.release_server(server, False)
+
+        return BenchmarkMethods.time_it(basecall, repeat=self.repeat,
+                                        setup=lambda: shutil.rmtree(basecalled_folder, ignore_errors=True))
+
+
+if __name__ == "__main__":
+    max_cpu = cpu_count()
+
+    parser = ArgumentParser(description='Time the non-GPU stages of the pipeline on a synthetic run, using stub '
+                                        'basecall server and client executables.')
+    parser.add_argument('-o', '--output', metavar='/path/to/benchmark_folder/',
+                        required=True, type=str,
+                        help='Folder to hold the synthetic data and the results. The synthetic run is reused '
+                             'between invocations with the same settings. Mandatory.')
+    parser.add_argument('--results', metavar='/path/to/results/',
+                        required=False, type=str,
+                        help='Folder to store the results (one json per invocation). Default is "results" in the '
+                             'output folder. Optional.')
+    parser.add_argument('--baseline', metavar='/path/to/benchmark_xxx.json',
+                        required=False, type=str,
+                        help='Previous results to compare against. Exits with an error if a scenario is slower by '
+                             'more than "--tolerance". Optional.')
+    parser.add_argument('--tolerance', metavar='0.1',
+                        required=False, type=float, default=0.1,
+                        help='Allowed slow down compared to the baseline, as a fraction. Default is 0.1. Optional.')
+    parser.add_argument('--scenarios', metavar='merge_barcode,filter',
+                        required=False, type=str,
+                        help='Comma-separated scenarios to run, among {}. Default is all. '
+                             'Optional.'.format(', '.join(Benchmark.scenarios)))
+    parser.add_argument('--barcodes', metavar='12',
+                        required=False, type=int, default=12,
+                        help='Number of barcodes, 0 for a run without barcoding. Default is 12. Optional.')
+    parser.add_argument('--chunks', metavar='20',
+                        required=False, type=int, default=20,
+                        help='Number of "fastq_runid_*" chunks per barcode. Default is 20. Optional.')
+    parser.add_argument('--reads-per-chunk', metavar='500',
+                        required=False, type=int, default=500,
+                        help='Average number of reads per chunk. Default is 500. Optional.')
+    parser.add_argument('--mean-length', metavar='3000',
+                        required=False, type=int, default=3000,
+                        help='Median read length. Default is 3000. Optional.')
+    parser.add_argument('--skew', metavar='1.0',
+                        required=False, type=float, default=1.0,
+                        help='Skew of the barcode distribution (Zipf exponent). 0 gives the same number of reads '
+                             'to every barcode. Default is 1.0. Optional.')
+    parser.add_argument('--raw-files', metavar='40',
+                        required=False, type=int, default=40,
+                        help='Number of placeholder pod5 files for the "basecall_stub" scenario. Default is 40. '
+                             'Optional.')
+    parser.add_argument('--prefetch', metavar='0',
+                        required=False, type=int, default=0,
+                        help='Prefetch depth for the "basecall_stub" scenario (see the pipeline\'s "--prefetch"). '
+                             'Default is 0. Optional.')
+    parser.add_argument('-t', '--threads', metavar=str(max_cpu),
+                        required=False, type=int, default=max_cpu,
+                        help='Number of threads. Default is maximum available({}). Optional.'.format(max_cpu))
+    parser.add_argument('-p', '--parallel', metavar='2',
+                        required=False, type=int, default=2,
+                        help='Number of samples to filter in parallel. Default is 2. Optional.')
+    parser.add_argument('--buffer-size', metavar='64',
+                        required=False, type=int, default=64,
+                        help='Maximum memory in MB used to buffer and compress the output of each sample being '
+                             'filtered. Default is 64. Optional.')
+    parser.add_argument('--repeat', metavar='1',
+                        required=False, type=int, default=1,
+                        help='Run each scenario this many times and keep the best time. Default is 1. Optional.')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='Keep the intermediate files of the scenarios. Optional.')
+    parser.add_argument('-v', '--version', action='version',
+                        version=f'{os.path.basename(__file__)}: version {__version__}')
+
+    # Get the arguments into an object
+    arguments = parser.parse_args()
+
+    Benchmark(arguments)
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import gzip
+import shutil
+import socket
+import platform
+import numpy as np
+
+
+class BenchmarkMethods(object):
+    # Synthetic Dorado-like output, to time the non-GPU parts of the pipeline without a sequencer or a GPU
+    stub_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+    run_id = '0123456789abcdef0123456789abcdef01234567'
+    start_time = 1704067200  # 2024-01-01T00:00:00+00:00
+
+    @staticmethod
+    def make_reads(rng, n_reads, mean_length, barcode, offset=0):
+        # Log-normal lengths and per-read quality levels, like a typical ligation run
+        lengths = np.maximum(rng.lognormal(np.log(mean_length), 0.6, n_reads).astype(np.int64), 50)
+        read_q = rng.uniform(7, 20, n_reads)
+        bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+        reads = list()
+        for i, length in enumerate(lengths):
+            seq = bases[rng.integers(0, 4, length)].tobytes()
+            qual = np.clip(rng.normal(read_q[i], 4, length), 1, 50).astype(np.uint8) + 33
+            start = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(BenchmarkMethods.start_time + (offset + i) % 172800))
+            header = ('@{:08x}-0000-4000-8000-{:012x} runid={} read={} ch={} start_time={}.000+00:00 '
+                      'flow_cell_id=FAX00000 barcode={}').format(rng.integers(0, 2 ** 32), offset + i,
+                                                                BenchmarkMethods.run_id, offset + i,
+                                                                rng.integers(1, 513), start, barcode or 'unclassified')
+            reads.append(b'\n'.join([header.encode(), seq, b'+', qual.tobytes(), b'']))
+        return reads
+
+    @staticmethod
+    def write_chunk(fastq, reads, level=1):
+        # Dorado writes small gzip files, fast compression is close enough
+        os.makedirs(os.path.dirname(fastq), exist_ok=True)
+        with gzip.open(fastq, 'wb', compresslevel=level) as f:
+            f.write(b''.join(reads))
+
+    @staticmethod
+    def barcode_weights(n_barcodes, skew):
+        # Zipf-like barcode distribution. skew=0 means even.
+        weights = 1 / np.arange(1, n_barcodes + 1) ** skew
+        return weights / weights.sum()
+
+    @staticmethod
+    def generate_run(basecalled_folder, n_barcodes, n_chunks, reads_per_chunk, mean_length, skew=1.0,
+                     fail_fraction=0.1, seed=1):
+        """
+        Write "fastq_runid_*" chunks the way ont_basecall_client does:
+        basecalled_folder
+            |-pass
+                |-barcode01
+                    |-fastq_runid_<run_id>_<i>_0.fastq.gz
+                |-...
+                |-unclassified
+            |-fail
+        Without barcodes (n_barcodes=0), the chunks go straight into "pass" and "fail".
+        """
+        rng = np.random.default_rng(seed)
+        barcodes = ['barcode{:02d}'.format(i + 1) for i in range(n_barcodes)]
+        if barcodes:
+            barcodes.append('unclassified')
+        weights = BenchmarkMethods.barcode_weights(len(barcodes), skew) if barcodes else [1.0]
+
+        n_reads = 0
+        n_bases = 0
+        for chunk in range(n_chunks):
+            for barcode, weight in zip(barcodes or [None], weights):
+                for i, fraction in [('pass', 1 - fail_fraction), ('fail', fail_fraction)]:
+                    n = int(round(reads_per_chunk * weight * fraction * len(weights)))
+                    if n == 0:
+                        continue
+                    reads = BenchmarkMethods.make_reads(rng, n, mean_length, barcode, n_reads)
+                    folder = basecalled_folder + i + '/' + (barcode + '/' if barcode else '')
+                    BenchmarkMethods.write_chunk(folder + 'fastq_runid_{}_{}_0.fastq.gz'.format(
+                        BenchmarkMethods.run_id, chunk), reads)
+                    n_reads += n
+                    n_bases += sum(len(r.split(b'\n')[1]) for r in reads)
+        return {'reads': n_reads, 'bases': n_bases}
+
+    @staticmethod
+    def generate_raw(input_folder, n_files, file_size):
+        # Placeholder pod5 files for the stub client. Their content is never read, only their size.
+        os.makedirs(input_folder, exist_ok=True)
+        for i in range(n_files):
+            with open(os.path.join(input_folder, 'FAX00000_{}_{}.pod5'.format(BenchmarkMethods.run_id[:8], i)),
+                      'wb') as f:
+                f.truncate(file_size)
+
+    @staticmethod
+    def use_stubs():
+        # Point the pipeline at the stub executables (see Methods.server_bin and client_bin). Must be called before
+        # basecall_nanopore_dorado_methods is imported.
+        os.environ['DORADO_BASECALL_SERVER'] = os.path.join(BenchmarkMethods.stub_folder, 'dorado_basecall_server')
+        os.environ['ONT_BASECALL_CLIENT'] = os.path.join(BenchmarkMethods.stub_folder, 'ont_basecall_client')
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    @staticmethod
+    def copy_tree(src, dst):
+        # Scenarios that modify their input start from a fresh copy
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
+
+    @staticmethod
+    def time_it(func, *args, repeat=1, setup=None):
+        # Best wall time of "repeat" calls. "setup" runs before each call and is not timed.
+        times = list()
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        return round(min(times), 4)
+
+    @staticmethod
+    def machine():
+        return {'host': socket.gethostname(),
+                'platform': platform.platform(),
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'cpu': os.cpu_count()}
+
+    @staticmethod
+    def save_results(results, results_folder):
+        os.makedirs(results_folder, exist_ok=True)
+        results_file = os.path.join(results_folder, 'benchmark_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+        with open(results_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        return results_file
+
+    @staticmethod
+    def compare(results, baseline_file, tolerance):
+        # Scenarios slower than the baseline by more than "tolerance" (fraction) are regressions
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        rows = list()
+        regressions = list()
+        for name, seconds in results['scenarios'].items():
+            before = baseline['scenarios'].get(name)
+            if before is None:
+                rows.append((name, '-', seconds, '-'))
+                continue
+            change = (seconds - before) / before if before else 0.0
+            rows.append((name, before, seconds, '{:+.1%}'.format(change)))
+            if change > tolerance:
+                regressions.append(name)
+        if baseline.get('settings') != results.get('settings'):
+            print('Warning: baseline was run with different settings')
+        print('{:<24}{:>12}{:>12}{:>10}'.format('scenario', 'baseline', 'current', 'change'))
+        for row in rows:
+            print('{:<24}{:>12}{:>12}{:>10}'.format(*row))
+        return regressions
@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+import threading
+
+
+class StageCache(object):
+    # Results already computed, per stage and per sample, kept in "stage_cache.json" in the output folder. Each entry
+    # has the key it was computed with (fingerprints of its inputs and the settings that matter) and the fingerprints
+    # of its outputs. A result is only reused if both still match, so a rerun with other settings or changed inputs
+    # recomputes what they affect and nothing else.
+    version = 1
+
+    def __init__(self, cache_file, work_folder, output_folder):
+        self.cache_file = cache_file
+        # Outputs are written in the work folder and checked in the output folder (they differ with "--scratch")
+        self.work_folder = os.path.abspath(work_folder)
+        self.output_folder = os.path.abspath(output_folder)
+        self.lock = threading.Lock()
+        self.cache = self.load()
+        self.stats = dict()  # stage -> number of results reused and computed, for the run report
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = dict()
+        if cache.get('version') != StageCache.version:
+            return {'version': StageCache.version, 'stages': dict()}
+        return cache
+
+    def save(self):
+        # Called with the lock held
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.cache, f, indent=1)
+        os.replace(tmp_file, self.cache_file)
+
+    @staticmethod
+    def fingerprint(path):
+        # Size and mtime (ns). Copies to and from the scratch folder keep the mtime (see StagingMethods).
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def make_key(**inputs):
+        # Digest of the settings and input fingerprints, whatever their order
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def raw_digest(raw_files):
+        # raw_files is a path -> (size, mtime, ...) dict, from the inventory or the ledger
+        digest = hashlib.sha1()
+        for path in sorted(raw_files):
+            size, mtime = raw_files[path][:2]
+            digest.update('{}\t{}\t{}\n'.format(path, size, mtime).encode())
+        return digest.hexdigest()
+
+    def entry(self, stage, name):
+        with self.lock:
+            return self.cache['stages'].get(stage, dict()).get(name)
+
+    def is_valid(self, stage, name, key, count=False):
+        # Same key, and outputs still in the output folder as they were written. "count" adds to the stats.
+        entry = self.entry(stage, name)
+        valid = entry is not None and entry['key'] == key and all(
+            StageCache.fingerprint(os.path.join(self.output_folder, path)) == fingerprint
+            for path, fingerprint in entry['outputs'].items())
+        if count:
+            with self.lock:
+                stat = self.stats.setdefault(stage, {'reused': 0, 'computed': 0})
+                stat['reused' if valid else 'computed'] += 1
+        return valid
+
+    def relative(self, path):
+        # Same name for the copy in the work folder and the one in the output folder
+        path = os.path.abspath(path)
+        if path.startswith(self.work_folder + os.sep):
+            return os.path.relpath(path, self.work_folder)
+        return os.path.relpath(path, self.output_folder)
+
+    def record(self, stage, name, key, outputs, **extra):
+        # "outputs" are paths in the work or output folder. Saved right away, so an interrupted run keeps what is done.
+        entry = {'key': key, 'outputs': {self.relative(x): StageCache.fingerprint(x) for x in outputs}}
+        entry.update(extra)
+        with self.lock:
+            self.cache['stages'].setdefault(stage, dict())[name] = entry
+            self.save()
+
+    def drop(self, stage, name):
+        with self.lock:
+            if self.cache['stages'].get(stage, dict()).pop(name, None) is not None:
+                self.save()
+
+    def clear(self):
+        with self.lock:
+            self.cache['stages'] = dict()
+            self.save()
@@ -0,0 +1,209 @@
+import os
+import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent import futures
+
+
+class ParallelGzipWriter(object):
+    # Multi-member gzip writer. Data is cut in fixed-size blocks compressed concurrently (zlib releases the GIL) and
+    # written in order. At most "threads * 2" blocks are in flight, so memory is bounded to about
+    # block_size * (threads * 2 + 1) whatever the size of the output.
+    def __init__(self, output_file, threads=1, block_size=4 * 1024 * 1024, level=6):
+        self.output_file = output_file
+        self.tmp_file = output_file + '.tmp'
+        self.block_size = max(64 * 1024, int(block_size))
+        self.level = level
+        self.threads = max(1, int(threads))
+        self.max_pending = self.threads * 2
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.f = open(self.tmp_file, 'wb')
+
+    @staticmethod
+    def compress_block(block, level):
+        return gzip.compress(block, compresslevel=level, mtime=0)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress_block, block, self.level))
+        while len(self.pending) > self.max_pending:
+            self._write_compressed(self.pending.popleft().result())
+
+    def _write_compressed(self, data):
+        self.f.write(data)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_compressed(self.pending.popleft().result())
+        self.executor.shutdown()
+        self._finish()
+        self.f.close()
+        os.replace(self.tmp_file, self.output_file)
+
+    def _finish(self):
+        pass
+
+    def abort(self):
+        # Drop everything, leaving no partial output behind
+        for job in self.pending:
+            job.cancel()
+        self.executor.shutdown()
+        self.f.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class BgzfWriter(ParallelGzipWriter):
+    # Same, in BGZF: gzip members of at most 64 KB holding their own compressed size, so "samtools faidx",
+    # "bgzip -b" or htslib based tools can seek and decompress in parallel. Optionally writes a ".gzi" index
+    # (compressed offset -> uncompressed offset of every block) next to the output.
+    bgzf_block_size = 65280  # Uncompressed bytes per BGZF block, same as bgzip
+    eof_block = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self, output_file, threads=1, block_size=4 * 1024 * 1024, level=6, index=False):
+        super().__init__(output_file, threads, block_size, level)
+        # Jobs hold whole BGZF blocks, so only the very last block can be short
+        self.block_size = max(1, self.block_size // BgzfWriter.bgzf_block_size) * BgzfWriter.bgzf_block_size
+        self.index = index
+        self.index_file = output_file + '.gzi'
+        self.entries = list()
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+
+    @staticmethod
+    def bgzf_block(data, level):
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)  # Raw deflate, the header is written here
+        deflated = c.compress(data) + c.flush()
+        block_size = 18 + len(deflated) + 8  # Header with the "BC" extra field + data + CRC32 and ISIZE
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+        return header + deflated + struct.pack('<2I', zlib.crc32(data), len(data))
+
+    @staticmethod
+    def compress_block(block, level):
+        # Returns the BGZF blocks and their (compressed, uncompressed) sizes, for the index
+        blocks = list()
+        sizes = list()
+        for i in range(0, len(block), BgzfWriter.bgzf_block_size):
+            data = block[i:i + BgzfWriter.bgzf_block_size]
+            blocks.append(BgzfWriter.bgzf_block(data, level))
+            sizes.append((len(blocks[-1]), len(data)))
+        return b''.join(blocks), sizes
+
+    def _write_compressed(self, result):
+        data, sizes = result
+        self.f.write(data)
+        for compressed_size, uncompressed_size in sizes:
+            self.entries.append((self.compressed_offset, self.uncompressed_offset))
+            self.compressed_offset += compressed_size
+            self.uncompressed_offset += uncompressed_size
+
+    def _finish(self):
+        self.f.write(BgzfWriter.eof_block)
+        if self.index:
+            # bgzip format: number of entries, then the offsets of every block but the first one (uint64, LE)
+            entries = self.entries[1:]
+            with open(self.index_file + '.tmp', 'wb') as f:
+                f.write(struct.pack('<Q', len(entries)))
+                f.write(b''.join(struct.pack('<2Q', c, u) for c, u in entries))
+            os.replace(self.index_file + '.tmp', self.index_file)
+
+
+class CompressMethods(object):
+    @staticmethod
+    def block_size_from_buffer(buffer_mb, threads):
+        # Split the per-sample memory budget between the blocks that can be in flight at once
+        return max(64 * 1024, int(buffer_mb * 1024 * 1024 / (max(1, int(threads)) * 2 + 1)))
+
+    @staticmethod
+    def stream_to_gzip(stream, output_file, threads, block_size, index=False):
+        # Copy a binary stream (e.g. a subprocess stdout) to a BGZF file, "block_size" bytes at a time
+        with BgzfWriter(output_file, threads, block_size, index=index) as out:
+            while True:
+                chunk = stream.read(block_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+    @staticmethod
+    def last_gzi_offset(index_file):
+        # Uncompressed offset of the last block listed in a ".gzi" index (0 if the file has a single block)
+        with open(index_file, 'rb') as f:
+            n = struct.unpack('<Q', f.read(8))[0]
+            if not n:
+                return 0
+            f.seek(8 + (n - 1) * 16 + 8)
+            return struct.unpack('<Q', f.read(8))[0]
+
+    @staticmethod
+    def is_bgzf(gzipped_file):
+        with open(gzipped_file, 'rb') as f:
+            header = f.read(18)
+        return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+    @staticmethod
+    def bgzf_size_from_index(gzipped_file, index_file):
+        # Uncompressed offset of the last block + its ISIZE, found right before the EOF block. Two small reads.
+        file_size = os.path.getsize(gzipped_file)
+        last_offset = CompressMethods.last_gzi_offset(index_file)
+        with open(gzipped_file, 'rb') as f:
+            f.seek(file_size - len(BgzfWriter.eof_block))
+            if f.read() != BgzfWriter.eof_block:
+                return None
+            if file_size == len(BgzfWriter.eof_block):
+                return 0
+            f.seek(file_size - len(BgzfWriter.eof_block) - 4)
+            return last_offset + struct.unpack('<I', f.read(4))[0]
+
+    @staticmethod
+    def bgzf_size_from_blocks(gzipped_file):
+        # Hop from block to block using the compressed size in each header and add up the ISIZE of the trailers
+        total = 0
+        with open(gzipped_file, 'rb') as f:
+            offset = 0
+            while True:
+                f.seek(offset)
+                header = f.read(18)
+                if not header:
+                    return total
+                if len(header) < 18 or header[12:14] != b'BC':
+                    return None  # Not BGZF past this point
+                block_size = struct.unpack('<H', header[16:18])[0] + 1
+                f.seek(offset + block_size - 4)
+                total += struct.unpack('<I', f.read(4))[0]
+                offset += block_size
+
+    @staticmethod
+    def gzipped_file_size(gzipped_file):
+        # Uncompressed size. BGZF files are measured from their index or block trailers without inflating anything;
+        # other gzip files have to be decompressed (their trailers are modulo 4 GB and members are not delimited).
+        index_file = gzipped_file + '.gzi'
+        size = None
+        if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(gzipped_file):
+            size = CompressMethods.bgzf_size_from_index(gzipped_file, index_file)
+        if size is None and CompressMethods.is_bgzf(gzipped_file):
+            size = CompressMethods.bgzf_size_from_blocks(gzipped_file)
+        if size is None:
+            with gzip.open(gzipped_file, 'rb') as f:
+                size = f.seek(0, whence=2)
+        return size
@@ -1,17 +1,21 @@
 import os
 import sys
+import json
 import subprocess
 
 
 class CondaMethods(object):
+    # "conda info --envs" takes seconds, so the env name -> prefix mapping is cached between runs
+    cache_file = os.path.join(os.path.expanduser('~'), '.cache', 'basecall_nanopore_dorado', 'conda_envs.json')
+    env_cache = None
+
     @staticmethod
     def is_conda_installed():
         return os.path.exists(os.path.join(sys.prefix, 'conda-meta'))
 
     @staticmethod
     def is_conda_env_installed(env):
-        cmd = ['conda', 'info', '--envs']
-        return env in subprocess.check_output(cmd).decode()
+        return CondaMethods.get_env_prefix(env) is not None
 
     @staticmethod
     def is_env_activated(env):
@@ -19,26 +23,92 @@ class CondaMethods(object):
 
     @staticmethod
     def get_conda_env_path(env):
-        cmd = ['conda', 'info', '--envs']
+        prefix = CondaMethods.get_env_prefix(env)
+        if prefix is None:
+            raise KeyError(env)
+        return prefix
+
+    @staticmethod
+    def query_envs():
+        cmd = ['conda', 'info', '--envs', '--json']
+        info = json.loads(subprocess.check_output(cmd).decode())
+        root = info.get('root_prefix', '')
         env_dict = dict()
-        env_out = subprocess.check_output(cmd).decode().split('\n')
-        for line in env_out:
-            if line.startswith('#') or line == '':
-                continue
-            e, p = line.split(' ', maxsplit=1)
-            e = e.strip()
-            p = p.strip()
-            env_dict[e] = p
+        for prefix in info['envs']:
+            name = 'base' if prefix == root else os.path.basename(prefix)
+            env_dict.setdefault(name, prefix)
+        return env_dict
 
-        return env_dict[env]
+    @staticmethod
+    def folders_signature(env_dict):
+        # Creating or removing an environment changes the mtime of the folder holding it ("<base>/envs" for base)
+        folders = sorted(set(os.path.join(p, 'envs') if e == 'base' else os.path.dirname(p)
+                             for e, p in env_dict.items()))
+        return {f: os.stat(f).st_mtime for f in folders if os.path.isdir(f)}
+
+    @staticmethod
+    def load_cache():
+        try:
+            with open(CondaMethods.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Stale if an environment disappeared or an env folder changed
+        envs = cache.get('envs', dict())
+        if any(not os.path.isdir(os.path.join(p, 'conda-meta')) for p in envs.values()):
+            return None
+        if cache.get('folders') != CondaMethods.folders_signature(envs):
+            return None
+        return envs
+
+    @staticmethod
+    def save_cache(env_dict):
+        os.makedirs(os.path.dirname(CondaMethods.cache_file), exist_ok=True)
+        tmp_file = CondaMethods.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'envs': env_dict, 'folders': CondaMethods.folders_signature(env_dict)}, f)
+        os.replace(tmp_file, CondaMethods.cache_file)
+
+    @staticmethod
+    def refresh_envs():
+        CondaMethods.env_cache = CondaMethods.query_envs()
+        CondaMethods.save_cache(CondaMethods.env_cache)
+        return CondaMethods.env_cache
+
+    @staticmethod
+    def get_env_prefix(env):
+        if CondaMethods.env_cache is None:
+            CondaMethods.env_cache = CondaMethods.load_cache()
+            if CondaMethods.env_cache is None:
+                CondaMethods.refresh_envs()
+        if env not in CondaMethods.env_cache:
+            # Maybe created since the cache was written
+            CondaMethods.refresh_envs()
+        return CondaMethods.env_cache.get(env)
+
+    @staticmethod
+    def tool_cmd(env, tool):
+        # Call the tool from the environment directly instead of through "conda run"
+        return [os.path.join(CondaMethods.get_conda_env_path(env), 'bin', tool)]
+
+    @staticmethod
+    def env_vars(env):
+        # What "conda activate" would set for the tools to find their libraries and helper binaries
+        prefix = CondaMethods.get_conda_env_path(env)
+        env_vars = dict(os.environ)
+        env_vars['PATH'] = os.path.join(prefix, 'bin') + os.pathsep + env_vars.get('PATH', '')
+        env_vars['CONDA_PREFIX'] = prefix
+        env_vars['CONDA_DEFAULT_ENV'] = env
+        return env_vars
 
     @staticmethod
     def install_pycoQC_env():
         cmd = ['conda', 'create', '-y', '-n', 'pycoQC', 'pycoQC=3.0.0']
         subprocess.run(cmd)
+        CondaMethods.refresh_envs()
 
     @staticmethod
     def install_nbc_env():
         cmd = ['conda', 'create', '-y', '-n', 'nbc', 'filtlong', 'pigz']
         subprocess.run(cmd)
-
+        CondaMethods.refresh_envs()
@@ -0,0 +1,141 @@
+import gzip
+import numpy as np
+
+
+class FastqBatch(object):
+    # Complete reads of one block of the uncompressed fastq. "data" is a view on the reader's buffer: it is only
+    # valid until the next batch, copy what needs to be kept.
+    def __init__(self, data, offset, starts, header_ends, ends, lengths, qscores):
+        self.data = data  # uint8 array
+        self.offset = offset  # Position of the block in the uncompressed fastq
+        self.starts = starts  # First byte of each read in the block ("@")
+        self.header_ends = header_ends  # Newline of each header
+        self.ends = ends  # One past the last byte of each read (after the newline of the quality line)
+        self.lengths = lengths
+        self.qscores = qscores
+
+    def __len__(self):
+        return len(self.starts)
+
+    def headers(self):
+        # Header lines, as bytes without the newline
+        data = self.data
+        return [data[s:e].tobytes() for s, e in zip(self.starts.tolist(), self.header_ends.tolist())]
+
+    def record(self, i):
+        return self.data[self.starts[i]:self.ends[i]].tobytes()
+
+
+class FastqMethods(object):
+    # Phred+33 character -> error probability
+    error_lut = np.power(10.0, -np.maximum(np.arange(256, dtype=np.float64) - 33, 0) / 10.0)
+    # Two characters at once (the block read as uint16): half the lookups. Symmetric, so byte order does not matter.
+    pair_error_lut = error_lut[np.arange(65536) & 255] + error_lut[np.arange(65536) >> 8]
+    batch_size = 4 * 1024 * 1024  # Uncompressed bytes parsed at once
+
+    @staticmethod
+    def open_fastq(fastq):
+        if fastq.endswith('.gz'):
+            return gzip.open(fastq, 'rb')
+        return open(fastq, 'rb')
+
+    @staticmethod
+    def block_qscores(data, qual_starts, qual_ends):
+        # Mean qscores of all the quality lines of a block. Error probabilities are looked up two characters at a
+        # time, then summed per line with "reduceat" over the pairs entirely inside the line, plus the odd characters
+        # at either end.
+        pairs = FastqMethods.pair_error_lut[data[:len(data) // 2 * 2].view(np.uint16)]
+        pair_starts = (qual_starts + 1) // 2
+        pair_ends = qual_ends // 2
+        bounds = np.column_stack((np.minimum(pair_starts, len(pairs) - 1), pair_ends)).ravel()
+        if bounds[-1] == len(pairs):
+            bounds = bounds[:-1]  # The last sum runs to the end anyway
+        sums = np.where(pair_ends > pair_starts, np.add.reduceat(pairs, bounds)[::2], 0)
+        sums += np.where(qual_starts % 2 == 1, FastqMethods.error_lut[data[qual_starts]], 0)
+        sums += np.where(qual_ends % 2 == 1, FastqMethods.error_lut[data[qual_ends - 1]], 0)
+        qual_lengths = qual_ends - qual_starts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            qscores = np.where(qual_lengths > 0, -10 * np.log10(sums / np.maximum(qual_lengths, 1)), 0)
+        return qscores.astype(np.float32)
+
+    @staticmethod
+    def parse_block(data, fastq, stats=True):
+        # Locate the complete reads of a block with one pass over the newlines. Returns the batch and the size of the
+        # complete reads (the rest is carried over to the next block).
+        newlines = np.flatnonzero(data == 10)
+        n_reads = len(newlines) // 4
+        newlines = newlines[:n_reads * 4].reshape(-1, 4)
+        ends = newlines[:, 3] + 1
+        starts = np.empty(n_reads, dtype=np.int64)
+        starts[:1] = 0
+        starts[1:] = ends[:-1]
+        if n_reads and (np.any(data[starts] != 64) or np.any(data[newlines[:, 1] + 1] != 43)):  # "@" and "+"
+            raise Exception('{} is not a valid fastq file (one read per 4 lines expected).'.format(fastq))
+
+        seq_starts = newlines[:, 0] + 1
+        lengths = (newlines[:, 1] - seq_starts).astype(np.uint32)
+        qual_starts = newlines[:, 2] + 1
+        qual_ends = newlines[:, 3]
+        if np.any(qual_ends - qual_starts != lengths):
+            raise Exception('{} is truncated or is not a valid fastq file (sequence and quality lengths '
+                            'differ).'.format(fastq))
+        qscores = None
+        if stats and n_reads:
+            qscores = FastqMethods.block_qscores(data[:int(ends[-1])], qual_starts, qual_ends)
+        return FastqBatch(data, 0, starts, newlines[:, 0], ends, lengths, qscores), int(ends[-1]) if n_reads else 0
+
+    @staticmethod
+    def iter_batches(fastq, batch_size=None, stats=True):
+        # Read the fastq in blocks and yield FastqBatch objects with the lengths and mean qscores of their reads,
+        # computed in bulk with NumPy. The block buffer is reused. Mean qscores are skipped with "stats=False" (e.g.
+        # when they come from the sidecar index).
+        batch_size = batch_size if batch_size else FastqMethods.batch_size
+        buffer = bytearray(batch_size)
+        filled = 0  # Bytes in the buffer, starting with the incomplete read carried over from the previous block
+        offset = 0
+        with FastqMethods.open_fastq(fastq) as f:
+            while True:
+                if filled == len(buffer):
+                    # A single read larger than the buffer
+                    buffer = buffer + bytearray(len(buffer))
+                with memoryview(buffer) as view:
+                    n = f.readinto(view[filled:])
+                eof = n == 0
+                filled += n
+                if eof:
+                    if not filled:
+                        break
+                    if buffer[filled - 1] != 10:
+                        # Last line without a newline
+                        if filled == len(buffer):
+                            buffer = buffer + b'\n'
+                        else:
+                            buffer[filled] = 10
+                        filled += 1
+
+                data = np.frombuffer(buffer, dtype=np.uint8, count=filled)
+                batch, used = FastqMethods.parse_block(data, fastq, stats)
+                batch.offset = offset
+                if len(batch):
+                    yield batch
+                del batch, data
+
+                if eof:
+                    if used < filled:
+                        raise Exception('{} is truncated or is not a valid fastq file.'.format(fastq))
+                    break
+                buffer[:filled - used] = buffer[used:filled]
+                filled -= used
+                offset += used
+
+    @staticmethod
+    def read_stats(fastq):
+        # Compact per-read arrays: 8 bytes per read regardless of read length
+        lengths = list()
+        qscores = list()
+        for batch in FastqMethods.iter_batches(fastq):
+            lengths.append(batch.lengths)
+            qscores.append(batch.qscores)
+        if not lengths:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float32)
+        return np.concatenate(lengths), np.concatenate(qscores)
@@ -0,0 +1,90 @@
+import numpy as np
+from fastq_methods import FastqMethods
+from compress_methods import BgzfWriter
+from index_methods import IndexMethods
+
+
+class FilterMethods(object):
+    @staticmethod
+    def score_reads(lengths, qscores):
+        # Filtlong-like score: geometric mean of a length score and a mean accuracy score (both 0-100)
+        length_score = 100 * np.log10(np.maximum(lengths, 1)) / np.log10(max(int(lengths.max(initial=1)), 10))
+        accuracy_score = 100 * (1 - np.power(10.0, -qscores.astype(np.float64) / 10))
+        return np.sqrt(length_score * accuracy_score)
+
+    @staticmethod
+    def select_keep_percent(lengths, scores, keep_percent, target_bases=None):
+        # Keep the best reads until "keep_percent" of the total bases is reached, like "filtlong --keep_percent".
+        # With "target_bases" (genome size x depth), stop there if it comes first, like "--target_bases".
+        keep = np.zeros(len(lengths), dtype=bool)
+        if not len(lengths):
+            return keep
+        order = np.argsort(-scores, kind='stable')
+        cum_bases = np.cumsum(lengths[order], dtype=np.uint64)
+        target = cum_bases[-1] * keep_percent / 100
+        if target_bases:
+            target = min(target, target_bases)
+        # Include the read crossing the target
+        n_keep = int(np.searchsorted(cum_bases, target, side='left')) + 1
+        keep[order[:n_keep]] = True
+        return keep
+
+    @staticmethod
+    def write_selected(input_fastq, keep, output_fastq, threads=1, block_size=4 * 1024 * 1024, index=False):
+        # Second pass: stream the reads again and only write the selected ones, by runs of consecutive reads
+        done = 0
+        with BgzfWriter(output_fastq, threads, block_size, index=index) as out:
+            for batch in FastqMethods.iter_batches(input_fastq, stats=False):
+                batch_keep = keep[done:done + len(batch)]
+                done += len(batch)
+                for start, stop in FilterMethods.keep_ranges(batch.starts, batch_keep):
+                    out.write(memoryview(batch.data[start:stop if stop is not None else batch.ends[-1]]))
+
+    @staticmethod
+    def keep_ranges(offsets, keep):
+        # Byte ranges of the uncompressed fastq to copy: runs of consecutive kept reads become a single range.
+        # An end of None means the end of the file.
+        flags = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+        starts = np.flatnonzero(flags == 1)
+        stops = np.flatnonzero(flags == -1)  # First dropped read after the run
+        return [(int(offsets[start]), int(offsets[stop]) if stop < len(offsets) else None)
+                for start, stop in zip(starts, stops)]
+
+    @staticmethod
+    def write_ranges(input_fastq, ranges, output_fastq, threads=1, block_size=4 * 1024 * 1024, index=False):
+        # Second pass with the sidecar index: copy the selected byte ranges of the decompressed stream as they go by,
+        # without splitting it into reads
+        with FastqMethods.open_fastq(input_fastq) as f, \
+                BgzfWriter(output_fastq, threads, block_size, index=index) as out:
+            position = 0
+            for start, end in ranges:
+                while position < start:  # Dropped reads
+                    data = f.read(min(block_size, start - position))
+                    if not data:
+                        raise Exception('{} is shorter than its index.'.format(input_fastq))
+                    position += len(data)
+                while end is None or position < end:
+                    data = f.read(block_size if end is None else min(block_size, end - position))
+                    if not data:
+                        if end is None:
+                            break
+                        raise Exception('{} is shorter than its index.'.format(input_fastq))
+                    out.write(data)
+                    position += len(data)
+
+    @staticmethod
+    def filter_fastq(input_fastq, output_fastq, keep_percent, threads=1, block_size=4 * 1024 * 1024, index=False,
+                     target_bases=None):
+        # The first pass (per-read lengths and qscores) is skipped when the sidecar index is up to date
+        fastq_index = IndexMethods.load_index(input_fastq)
+        if fastq_index is None:
+            lengths, qscores = FastqMethods.read_stats(input_fastq)
+        else:
+            lengths, qscores = np.asarray(fastq_index['length']), np.asarray(fastq_index['qscore'])
+        keep = FilterMethods.select_keep_percent(lengths, FilterMethods.score_reads(lengths, qscores), keep_percent,
+                                                 target_bases)
+        if fastq_index is None:
+            FilterMethods.write_selected(input_fastq, keep, output_fastq, threads, block_size, index)
+        else:
+            ranges = FilterMethods.keep_ranges(np.asarray(fastq_index['offset']), keep)
+            FilterMethods.write_ranges(input_fastq, ranges, output_fastq, threads, block_size, index)
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from fastq_methods import FastqMethods
+
+
+class IndexMethods(object):
+    # Sidecar index of a merged fastq: one 16-byte record per read with its offset in the uncompressed fastq, its
+    # length and its mean qscore. Saved as ".npy" so it can be memory-mapped, and the later stages (summary, QC,
+    # filtering) do not need to decompress and parse the fastq again to get per-read statistics.
+    index_dtype = np.dtype([('offset', '<u8'), ('length', '<u4'), ('qscore', '<f4')])
+    suffix = '.idx.npy'
+
+    @staticmethod
+    def index_file(fastq):
+        return fastq + IndexMethods.suffix
+
+    @staticmethod
+    def index_records(fastq):
+        # Returns the index of a single fastq and its uncompressed size
+        parts = list()
+        size = 0
+        for batch in FastqMethods.iter_batches(fastq):
+            index = np.zeros(len(batch), dtype=IndexMethods.index_dtype)
+            index['offset'] = batch.offset + batch.starts
+            index['length'] = batch.lengths
+            index['qscore'] = batch.qscores
+            parts.append(index)
+            size = batch.offset + int(batch.ends[-1])
+        if not parts:
+            return np.zeros(0, dtype=IndexMethods.index_dtype), size
+        return np.concatenate(parts), size
+
+    @staticmethod
+    def index_chunks(file_list):
+        # Index of the concatenation of the chunks, in the order they are merged
+        parts = list()
+        shift = 0
+        for chunk in file_list:
+            index, size = IndexMethods.index_records(chunk)
+            index['offset'] += shift
+            parts.append(index)
+            shift += size
+        if not parts:
+            return np.zeros(0, dtype=IndexMethods.index_dtype)
+        return np.concatenate(parts)
+
+    @staticmethod
+    def save_index(index, fastq):
+        # Written after the fastq, so a newer index is a valid one (see load_index)
+        index_file = IndexMethods.index_file(fastq)
+        tmp_file = index_file + '.tmp.npy'
+        np.save(tmp_file, index)
+        os.replace(tmp_file, index_file)
+
+    @staticmethod
+    def load_index(fastq, mmap=True):
+        # None if there is no index or if the fastq was modified after it (e.g. appended to in watch mode)
+        index_file = IndexMethods.index_file(fastq)
+        try:
+            if os.path.getmtime(index_file) < os.path.getmtime(fastq):
+                return None
+            return np.load(index_file, mmap_mode='r' if mmap else None)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def rename_index(fastq, new_fastq):
+        # Follow the fastq when it is renamed
+        if os.path.exists(IndexMethods.index_file(fastq)):
+            os.replace(IndexMethods.index_file(fastq), IndexMethods.index_file(new_fastq))
+
+    @staticmethod
+    def n50(lengths):
+        if not len(lengths):
+            return 0
+        lengths = np.sort(np.asarray(lengths, dtype=np.uint64))[::-1]
+        cum_bases = np.cumsum(lengths)
+        return int(lengths[np.searchsorted(cum_bases, cum_bases[-1] / 2)])
+
+    @staticmethod
+    def stats(index):
+        # Read count, yield, N50 and mean qscore without touching the fastq
+        lengths = index['length']
+        return {'reads': int(len(index)),
+                'bases': int(lengths.sum(dtype=np.uint64)),
+                'n50': IndexMethods.n50(lengths),
+                'mean_qscore': round(float(index['qscore'].mean()), 2) if len(index) else 0.0}
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+
+
+class InventoryMethods(object):
+    # Files modified less than this many seconds before the previous scan may still be growing, so they are stat'ed
+    # again even if their folder did not change.
+    recent = 300
+
+    @staticmethod
+    def new_inventory(input_folder, recursive):
+        # dirs: folder -> [mtime, [sub folders]]
+        # files: path -> [size, mtime, format]
+        return {'input': input_folder, 'recursive': recursive, 'scan_time': 0, 'dirs': dict(), 'files': dict()}
+
+    @staticmethod
+    def load(inventory_file, input_folder, recursive):
+        try:
+            with open(inventory_file, 'r') as f:
+                inventory = json.load(f)
+        except (OSError, ValueError):
+            return InventoryMethods.new_inventory(input_folder, recursive)
+        if inventory.get('input') != input_folder or inventory.get('recursive') != recursive:
+            return InventoryMethods.new_inventory(input_folder, recursive)
+        return inventory
+
+    @staticmethod
+    def save(inventory_file, inventory):
+        tmp_file = inventory_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(inventory, f)
+        os.replace(tmp_file, inventory_file)
+
+    @staticmethod
+    def scan_folder(folder):
+        sub_folders = list()
+        files = dict()
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_folders.append(entry.path)
+                elif entry.name.endswith(('.fast5', '.pod5')):
+                    stat = entry.stat()
+                    files[entry.path] = [stat.st_size, stat.st_mtime, entry.name.rsplit('.', 1)[1]]
+        return sub_folders, files
+
+    @staticmethod
+    def refresh(inventory):
+        # A folder's mtime only changes when entries are added, removed or renamed. Unchanged folders are not listed
+        # again, only their recent files are stat'ed.
+        old_dirs = inventory['dirs']
+        old_files = dict()
+        for path, entry in inventory['files'].items():
+            old_files.setdefault(os.path.dirname(path), dict())[path] = entry
+        recent_limit = inventory['scan_time'] - InventoryMethods.recent
+
+        dirs = dict()
+        files = dict()
+        folders = [inventory['input']]
+        while folders:
+            folder = folders.pop()
+            mtime = os.stat(folder).st_mtime
+            # Folders modified around the previous scan are listed again, in case of coarse mtime resolution
+            if folder in old_dirs and old_dirs[folder][0] == mtime and mtime < inventory['scan_time'] - 2:
+                sub_folders = old_dirs[folder][1]
+                folder_files = old_files.get(folder, dict())
+                for path, entry in folder_files.items():
+                    if entry[1] >= recent_limit:
+                        stat = os.stat(path)
+                        entry[:2] = [stat.st_size, stat.st_mtime]
+            else:
+                sub_folders, folder_files = InventoryMethods.scan_folder(folder)
+
+            dirs[folder] = [mtime, sub_folders]
+            files.update(folder_files)
+            if inventory['recursive']:
+                folders.extend(sub_folders)
+
+        inventory['dirs'] = dirs
+        inventory['files'] = files
+        inventory['scan_time'] = time.time()
+        return inventory
+
+    @staticmethod
+    def get_inventory(input_folder, recursive, inventory_file):
+        inventory = InventoryMethods.refresh(InventoryMethods.load(inventory_file, input_folder, recursive))
+        InventoryMethods.save(inventory_file, inventory)
+        return inventory
+
+    @staticmethod
+    def raw_files(inventory):
+        # path -> (size, mtime), as used by the ledger and the shards
+        return {path: (entry[0], entry[1]) for path, entry in inventory['files'].items()}
+
+    @staticmethod
+    def total_size(inventory):
+        return sum(entry[0] for entry in inventory['files'].values())
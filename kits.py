@@ -129,3 +129,9 @@ class Kits(object):
                                'rna_rp4_130bps_hac_mk1c.cfg',
                                'rna_rp4_130bps_hac_prom.cfg',
                                'rna_rp4_130bps_sup.cfg']
+
+    # Hashed versions for the checks
+    barcoding_kit_set = frozenset(barcoding_kit_list)
+    library_kit_set = frozenset(library_kit_list)
+    flowcell_set = frozenset(flowcell_list)
+    configuration_file_set = frozenset(configuration_file_list)
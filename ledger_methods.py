@@ -0,0 +1,37 @@
+import os
+import threading
+
+
+class LedgerMethods(object):
+    # Append-only record of the raw files already basecalled: path, size, mtime and the shard/batch holding its reads
+    lock = threading.Lock()
+
+    @staticmethod
+    def load(ledger_file):
+        ledger = dict()
+        if not os.path.exists(ledger_file):
+            return ledger
+        with open(ledger_file, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 4:
+                    continue  # Line cut by a crash
+                path, size, mtime, chunk = fields
+                ledger[path] = (int(size), float(mtime), chunk)
+        return ledger
+
+    @staticmethod
+    def record(ledger_file, raw_files, chunk):
+        # raw_files is a path -> (size, mtime) dict. Synced to disk so a crash right after does not lose it.
+        with LedgerMethods.lock:
+            with open(ledger_file, 'a') as f:
+                for path, (size, mtime) in sorted(raw_files.items()):
+                    f.write('{}\t{}\t{}\t{}\n'.format(path, size, mtime, chunk))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def pending(raw_files, ledger):
+        # Files never basecalled, or modified since
+        return {path: (size, mtime) for path, (size, mtime) in raw_files.items()
+                if path not in ledger or ledger[path][:2] != (size, mtime)}
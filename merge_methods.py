@@ -0,0 +1,110 @@
+import os
+import shutil
+
+
+class MergeMethods(object):
+    # Bytes handed to the kernel per copy call
+    copy_chunk = 64 * 1024 * 1024
+
+    @staticmethod
+    def kernel_copy(fd_in, fd_out, size):
+        # Try copy_file_range first (server-side copy on NFS 4.2, reflink on XFS/Btrfs), then sendfile
+        copied = 0
+        for copy_func in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, copy_func):
+                continue
+            try:
+                while copied < size:
+                    n = min(MergeMethods.copy_chunk, size - copied)
+                    if copy_func == 'copy_file_range':
+                        sent = os.copy_file_range(fd_in, fd_out, n)
+                    else:
+                        sent = os.sendfile(fd_out, fd_in, None, n)
+                    if sent == 0:
+                        break
+                    copied += sent
+                return copied
+            except OSError:
+                # Not supported by this filesystem pair. File offsets moved together, so resume from there.
+                continue
+        return copied
+
+    @staticmethod
+    def copy_into(src, fd_out):
+        with open(src, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            copied = MergeMethods.kernel_copy(fd.fileno(), fd_out.fileno(), size)
+            if copied < size:
+                # Userspace fallback for whatever the kernel could not copy
+                fd.seek(copied)
+                fd_out.seek(0, os.SEEK_END)
+                shutil.copyfileobj(fd, fd_out, MergeMethods.copy_chunk)
+                # The next chunk's kernel copy writes at the file descriptor's offset, past the buffer
+                fd_out.flush()
+
+    @staticmethod
+    def merge_files_atomic(file_list, merged_file, index=False):
+        # Nothing to merge (e.g. empty barcode folder)
+        if not file_list:
+            return
+
+        # A single chunk is simply renamed
+        if len(file_list) == 1:
+            os.replace(file_list[0], merged_file)
+            if index:
+                MergeMethods.index_merged([merged_file], merged_file)
+            return
+
+        # Gzip members can be concatenated as is. Write to a temporary file first so an interrupted merge never
+        # leaves a truncated output behind, and only delete the chunks once the merged file is in place.
+        tmp_file = merged_file + '.tmp'
+        with open(tmp_file, 'wb') as wfd:
+            for f in sorted(file_list):
+                MergeMethods.copy_into(f, wfd)
+            wfd.flush()
+            os.fsync(wfd.fileno())
+        os.replace(tmp_file, merged_file)
+
+        # The chunks are indexed one by one, while they are still there, so the merged file is never read back
+        if index:
+            MergeMethods.index_merged(sorted(file_list), merged_file)
+
+        for f in file_list:
+            os.remove(f)
+
+    @staticmethod
+    def index_merged(file_list, merged_file):
+        # Sidecar index of the merged fastq (see IndexMethods). NumPy is only loaded when indexing.
+        from index_methods import IndexMethods
+        IndexMethods.save_index(IndexMethods.index_chunks(file_list), merged_file)
+
+    @staticmethod
+    def append_files(file_list, target_file):
+        # Append chunks to an existing output in place, deleting each chunk once it is safely written.
+        # O_APPEND is avoided on purpose because copy_file_range refuses it.
+        # The size of the output before each chunk is kept in "<output>.append", so a chunk cut by a crash is taken
+        # out again before being appended anew (the chunk is only deleted once fully appended).
+        state_file = target_file + '.append'
+        with open(target_file, 'r+b' if os.path.exists(target_file) else 'wb') as wfd:
+            if os.path.exists(state_file):
+                with open(state_file, 'r') as f:
+                    fields = f.read().split('\t')
+                if len(fields) == 2 and os.path.exists(fields[1]):
+                    wfd.truncate(int(fields[0]))
+            for f in sorted(file_list):
+                wfd.seek(0, os.SEEK_END)
+                MergeMethods.write_synced(state_file, '{}\t{}'.format(wfd.tell(), f))
+                MergeMethods.copy_into(f, wfd)
+                wfd.flush()
+                os.fsync(wfd.fileno())
+                os.remove(f)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+
+    @staticmethod
+    def write_synced(path, text):
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
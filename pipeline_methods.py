@@ -0,0 +1,169 @@
+import os
+import time
+import resource
+import itertools
+import threading
+import multiprocessing
+from concurrent import futures
+import psutil
+
+
+class JobSizing(object):
+    # Rough resource needs of a sample's jobs, from the size of its compressed fastq. Estimates err on the high side.
+    process_memory = 200 * 1024 * 1024  # Python process with NumPy loaded
+    compression_ratio = 3  # fastq.gz -> fastq
+    read_bytes = 2000  # uncompressed fastq bytes per read, for short reads to be on the safe side
+    filter_read_memory = 40  # bytes per read: lengths, qscores, scores, sort order and keep mask
+    summary_read_memory = 80  # bytes per read: summary record and parsing
+    bytes_per_thread = 256 * 1024 * 1024  # compressed input per compression thread
+
+    @staticmethod
+    def n_reads(input_size):
+        return input_size * JobSizing.compression_ratio // JobSizing.read_bytes
+
+    @staticmethod
+    def filter_job(input_size, cpu, buffer_mb):
+        # Big samples get more compression threads. The output buffer is "--buffer-size" whatever the threads.
+        threads = max(1, min(int(cpu), -(-input_size // JobSizing.bytes_per_thread)))
+        mem = (JobSizing.process_memory + buffer_mb * 1024 * 1024
+               + JobSizing.n_reads(input_size) * JobSizing.filter_read_memory)
+        return threads, mem
+
+    @staticmethod
+    def summary_job(input_size):
+        return JobSizing.process_memory + JobSizing.n_reads(input_size) * JobSizing.summary_read_memory
+
+    @staticmethod
+    def file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+
+class StageScheduler(object):
+    # Runs per-sample tasks as soon as their inputs exist, instead of waiting for a whole stage to finish. Every task
+    # declares how many CPUs and how much memory it needs and only starts once they are free in the shared budget
+    # ("--threads" and "--memory"). Waiting tasks start largest first; a smaller one can only start ahead of a larger
+    # one if the larger does not fit yet, so cores do not idle while big samples wait for memory.
+    # Python-heavy tasks run in a process pool, tasks that launch external tools run in a thread.
+    def __init__(self, cpu, mem=None, limits=None):
+        self.cpu = max(1, int(cpu))
+        self.mem = int(mem) if mem else None  # bytes, None for no limit
+        self.available = self.cpu
+        self.available_mem = self.mem
+        self.limits = limits if limits else dict()  # group -> maximum number of tasks running at once
+        self.running = dict()
+        self.waiting = list()
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        # Threads mostly wait (for resources or for a child process), so there can be more of them than CPUs
+        self.threads = futures.ThreadPoolExecutor(max_workers=self.cpu * 4)
+        # "forkserver" because forking a process that runs threads can deadlock
+        self.processes = futures.ProcessPoolExecutor(max_workers=self.cpu,
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+        self.jobs = list()
+        self.jobs_lock = threading.Lock()
+        # Task name -> number of tasks, time spent running (not waiting for resources) and, for the tasks run in the
+        # process pool, their CPU time and bytes read and written. For the run report.
+        self.stats = dict()
+
+    def fits(self, request):
+        _, _, cpus, mem, group = request
+        if cpus > self.available:
+            return False
+        if self.mem is not None and mem > self.available_mem:
+            return False
+        if group in self.limits and self.running.get(group, 0) >= self.limits[group]:
+            return False
+        return True
+
+    def can_start(self, request):
+        # Waiting requests are sorted largest first
+        for other in self.waiting:
+            if other is request:
+                return self.fits(request)
+            if self.fits(other):
+                return False  # A larger one goes first
+        return False
+
+    def acquire(self, cpus, mem=0, size=0, group=None):
+        request = (-size, next(self.counter), cpus, mem, group)
+        with self.condition:
+            self.waiting.append(request)
+            self.waiting.sort(key=lambda x: x[:2])
+            self.condition.wait_for(lambda: self.can_start(request))
+            self.waiting.remove(request)
+            self.available -= cpus
+            if self.mem is not None:
+                self.available_mem -= mem
+            self.running[group] = self.running.get(group, 0) + 1
+            # Requests that waited behind this one may fit now
+            self.condition.notify_all()
+
+    def release(self, cpus, mem=0, group=None):
+        with self.condition:
+            self.available += cpus
+            if self.mem is not None:
+                self.available_mem += mem
+            self.running[group] -= 1
+            self.condition.notify_all()
+
+    @staticmethod
+    def run_measured(func, *args):
+        # Runs in a pool worker: returns the result and what the task used there. The workers are never waited for,
+        # so their usage is not in the parent's "RUSAGE_CHILDREN".
+        process = psutil.Process()
+        start = resource.getrusage(resource.RUSAGE_SELF)
+        start_io = process.io_counters()
+        result = func(*args)
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        end_io = process.io_counters()
+        return result, {'cpu_seconds': end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime,
+                        'bytes_read': end_io.read_bytes - start_io.read_bytes,
+                        'bytes_written': end_io.write_bytes - start_io.write_bytes}
+
+    def submit(self, func, *args, cpus=1, mem=0, size=0, group=None, process=False, name=None):
+        # "size" orders the waiting tasks (e.g. input bytes). A task larger than the whole budget runs alone.
+        cpus = max(1, min(int(cpus), self.cpu))
+        mem = min(int(mem), self.mem) if self.mem is not None else 0
+        name = name if name else func.__name__
+
+        def task():
+            self.acquire(cpus, mem, size, group)
+            start = time.time()
+            usage = dict()
+            try:
+                if process:
+                    result, usage = self.processes.submit(StageScheduler.run_measured, func, *args).result()
+                    return result
+                return func(*args)
+            finally:
+                self.release(cpus, mem, group)
+                with self.jobs_lock:
+                    stat = self.stats.setdefault(name, {'tasks': 0, 'busy_seconds': 0.0})
+                    stat['tasks'] += 1
+                    stat['busy_seconds'] = round(stat['busy_seconds'] + time.time() - start, 3)
+                    for key, value in usage.items():
+                        stat[key] = round(stat.get(key, 0) + value, 3)
+
+        job = self.threads.submit(task)
+        with self.jobs_lock:
+            self.jobs.append(job)
+        return job
+
+    def wait(self):
+        # Tasks can submit other tasks, so keep waiting until no new job shows up
+        done = 0
+        while True:
+            with self.jobs_lock:
+                jobs = self.jobs[done:]
+            if not jobs:
+                break
+            for job in jobs:
+                job.result()  # Propagate errors
+            done += len(jobs)
+
+    def shutdown(self):
+        self.threads.shutdown()
+        self.processes.shutdown()
@@ -0,0 +1,132 @@
+import os
+import time
+import shutil
+import threading
+
+
+class RawPrefetcher(object):
+    # Copies the raw files of the next shards from slow (network) storage to a local cache while the clients basecall
+    # the current ones. Shards are prefetched in the order the clients take them, at most "depth" shards ahead, and
+    # the cache never holds more than "max_bytes" (a shard larger than that is only copied once the cache is empty).
+    # A shard is evicted as soon as it is basecalled. If a copy fails (e.g. disk full), the shard is read in place.
+    copy_chunk = 16 * 1024 * 1024
+
+    def __init__(self, shards, raw_files, cache_folder, depth, max_bytes):
+        self.shards = shards  # List of (shard_name, list of paths), in queue order
+        self.originals = dict(shards)
+        self.raw_files = raw_files  # path -> (size, mtime)
+        self.cache_folder = cache_folder
+        self.depth = max(1, int(depth))
+        self.max_bytes = max_bytes
+        self.ready = dict()  # shard_name -> local paths (or the original ones if the copy failed)
+        self.sizes = dict()
+        self.taken = set()
+        self.cached_bytes = 0
+        self.stop = False
+        self.condition = threading.Condition()
+        self.stats = {'shards': 0, 'hits': 0, 'stalls': 0, 'stall_seconds': 0.0, 'bytes': 0, 'copy_seconds': 0.0,
+                      'failed': 0}
+        self.thread = threading.Thread(target=self.prefetch, name='prefetch', daemon=True)
+
+    @staticmethod
+    def shard_target(total_bytes, n_servers, depth, max_bytes):
+        # Number of shards needed for the shards in use plus the prefetched ones to fit in the cache
+        per_shard = max_bytes / (n_servers + max(1, int(depth)))
+        return int(-(-total_bytes // per_shard)) if per_shard > 0 else 1
+
+    def start(self):
+        # None if the cache folder cannot be made: everything is then read in place
+        shutil.rmtree(self.cache_folder, ignore_errors=True)  # Left by an interrupted run
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+        except OSError as e:
+            print('\tCould not make the prefetch folder ({}), reading the raw files in place'.format(e))
+            return None
+        self.thread.start()
+        return self
+
+    def waiting(self):
+        # Prefetched shards no client has taken yet
+        return sum(1 for name in self.ready if name not in self.taken)
+
+    def copy_file(self, path, target):
+        # In chunks, so that "close" does not wait for a whole file
+        with open(path, 'rb') as fin, open(target, 'wb') as fout:
+            while not self.stop:
+                data = fin.read(RawPrefetcher.copy_chunk)
+                if not data:
+                    return
+                fout.write(data)
+
+    def copy_shard(self, shard_name, shard):
+        # Flat copy, the client gets the file names in a list
+        names = [os.path.basename(x) for x in shard]
+        if len(set(names)) != len(names):
+            return shard  # Same file name in different sub-folders
+        folder = os.path.join(self.cache_folder, shard_name)
+        start = time.time()
+        try:
+            os.makedirs(folder, exist_ok=True)
+            local = list()
+            for path in shard:
+                target = os.path.join(folder, os.path.basename(path))
+                self.copy_file(path, target)
+                local.append(target)
+        except Exception as e:
+            print('\tCould not prefetch {} ({}), reading it in place'.format(shard_name, e))
+            shutil.rmtree(folder, ignore_errors=True)
+            with self.condition:
+                self.stats['failed'] += 1
+            return shard
+        with self.condition:
+            self.stats['bytes'] += sum(self.raw_files[x][0] for x in shard)
+            self.stats['copy_seconds'] = round(self.stats['copy_seconds'] + time.time() - start, 3)
+        return local
+
+    def prefetch(self):
+        for shard_name, shard in self.shards:
+            size = sum(self.raw_files[x][0] for x in shard)
+            with self.condition:
+                self.condition.wait_for(lambda: self.stop or (self.waiting() < self.depth and (
+                    self.cached_bytes + size <= self.max_bytes or self.cached_bytes == 0)))
+                if self.stop:
+                    return
+                self.cached_bytes += size
+                self.sizes[shard_name] = size
+            local = self.copy_shard(shard_name, shard)
+            with self.condition:
+                self.ready[shard_name] = local
+                self.condition.notify_all()
+
+    def get(self, shard_name):
+        # Paths for the client. Waits for the copy if it is not done yet (a stall). If the prefetch thread is gone
+        # (it died, or the prefetcher is closed), the shard is read in place.
+        with self.condition:
+            self.stats['shards'] += 1
+            if shard_name in self.ready:
+                self.stats['hits'] += 1
+            else:
+                start = time.time()
+                self.stats['stalls'] += 1
+                # With a timeout: nothing notifies when the thread dies
+                while not self.condition.wait_for(lambda: shard_name in self.ready or not self.thread.is_alive(),
+                                                  timeout=1):
+                    pass
+                self.stats['stall_seconds'] = round(self.stats['stall_seconds'] + time.time() - start, 3)
+            self.taken.add(shard_name)
+            self.condition.notify_all()
+            return self.ready.get(shard_name, self.originals[shard_name])
+
+    def release(self, shard_name):
+        # Basecalled (or failed): free its space for the next ones
+        shutil.rmtree(os.path.join(self.cache_folder, shard_name), ignore_errors=True)
+        with self.condition:
+            self.cached_bytes -= self.sizes.pop(shard_name, 0)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.stop = True
+            self.condition.notify_all()
+        self.thread.join()
+        shutil.rmtree(self.cache_folder, ignore_errors=True)
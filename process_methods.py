@@ -0,0 +1,200 @@
+import os
+import re
+import signal
+import asyncio
+import threading
+import subprocess
+
+
+class ClientProgress(object):
+    # Parses the "[PROG_STAT]" lines ont_basecall_client prints with "--progress_stats_frequency":
+    # time elapsed (s), time remaining (estimate), reads processed, total reads (estimate), interval (s),
+    # interval reads processed, interval bases processed
+    pattern = re.compile(r'\[PROG_STAT\]\s*([\d.,\s]+)$')
+
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.total_reads = 0
+        self.bases = 0
+        self.elapsed = 0.0
+        self.reads_per_second = 0.0
+
+    def __call__(self, line):
+        match = ClientProgress.pattern.search(line)
+        if not match:
+            return
+        try:
+            elapsed, _, reads, total_reads, interval, interval_reads, interval_bases = \
+                [float(x) for x in match.group(1).split(',')]
+        except ValueError:
+            return
+        self.elapsed = elapsed
+        self.reads = int(reads)
+        self.total_reads = int(total_reads)
+        self.bases += int(interval_bases)
+        self.reads_per_second = interval_reads / interval if interval else 0.0
+        percent = 100 * self.reads / self.total_reads if self.total_reads else 0
+        print('\t{}: {} reads ({:.0f}%), {:.0f} reads/s'.format(self.name, self.reads, percent,
+                                                               self.reads_per_second))
+
+
+class ManagedProcess(object):
+    # Handle on a process started by ProcessManager.start, usable from any thread (same calls as subprocess.Popen)
+    def __init__(self, process, task):
+        self.process = process
+        self.task = task
+        self.pid = process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def poll(self):
+        return self.process.returncode
+
+    def terminate(self):
+        ProcessManager.submit(ProcessManager.stop(self.process)).result()
+
+    def wait(self):
+        return ProcessManager.submit(self.process.wait()).result()
+
+
+class ProcessManager(object):
+    # All child processes run on one asyncio event loop living in a background thread. The pipeline's threads
+    # submit commands and block on the result. Every process gets its own session so it can be stopped with all its
+    # children (timeout, error or Ctrl-C).
+    loop = None
+    loop_lock = threading.Lock()
+    running = set()
+    timeout = None  # Default seconds allowed per process (None for no limit)
+    grace = 10  # Seconds between SIGTERM and SIGKILL
+
+    @staticmethod
+    def get_loop():
+        with ProcessManager.loop_lock:
+            if ProcessManager.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='process_manager', daemon=True).start()
+                ProcessManager.loop = loop
+            return ProcessManager.loop
+
+    @staticmethod
+    def submit(coro):
+        return asyncio.run_coroutine_threadsafe(coro, ProcessManager.get_loop())
+
+    @staticmethod
+    async def stop(process):
+        # SIGTERM the whole process group, then SIGKILL it if it is still there after the grace period
+        if process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            await asyncio.wait_for(process.wait(), ProcessManager.grace)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    @staticmethod
+    async def pump(stream, log, on_line):
+        # Copy a child's output to its log, line by line, handing each line to the progress parser
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            log.write(line)
+            log.flush()
+            if on_line:
+                on_line(line.decode(errors='replace').rstrip())
+
+    @staticmethod
+    async def spawn(cmd, log_file, cwd=None, env=None, stdout=None, on_line=None):
+        # stdout: None to log it, or a file descriptor to send it somewhere else (e.g. a pipe read by a compressor).
+        # The descriptor is closed here once the child has its copy.
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        log = open(log_file, 'ab')
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if stdout is None else stdout, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True, limit=1024 * 1024)
+        except OSError:
+            log.close()
+            raise
+        finally:
+            if stdout is not None:
+                os.close(stdout)
+        streams = [process.stderr] if stdout is not None else [process.stdout, process.stderr]
+
+        async def watch():
+            try:
+                await asyncio.gather(*[ProcessManager.pump(s, log, on_line) for s in streams])
+                await process.wait()
+            finally:
+                log.close()
+                ProcessManager.running.discard(process)
+
+        ProcessManager.running.add(process)
+        return process, asyncio.ensure_future(watch())
+
+    @staticmethod
+    async def run_async(cmd, log_file, cwd=None, env=None, timeout=None, stdout=None, on_line=None):
+        timeout = timeout if timeout else ProcessManager.timeout
+        process, task = await ProcessManager.spawn(cmd, log_file, cwd, env, stdout, on_line)
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            await ProcessManager.stop(process)
+            raise Exception('{} did not finish within {} seconds. See {}'.format(os.path.basename(cmd[0]),
+                                                                                timeout, log_file))
+        finally:
+            # Cancelled or timed out: make sure nothing is left running
+            await ProcessManager.stop(process)
+            await task
+        return process.returncode
+
+    @staticmethod
+    def run(cmd, log_file, cwd=None, env=None, timeout=None, stdout=None, on_line=None, check=True):
+        # Blocking. Raises if the process fails (unless check=False) or runs past the timeout.
+        returncode = ProcessManager.submit(ProcessManager.run_async(cmd, log_file, cwd, env, timeout, stdout,
+                                                                    on_line)).result()
+        if check and returncode != 0:
+            raise Exception('{} exited with code {}. See {}'.format(os.path.basename(cmd[0]), returncode, log_file))
+        return returncode
+
+    @staticmethod
+    def run_piped(cmd, log_file, consumer, cwd=None, env=None, timeout=None):
+        # Run a tool writing its result to stdout, and hand the stream to "consumer" in the calling thread
+        read_fd, write_fd = os.pipe()
+        future = ProcessManager.submit(ProcessManager.run_async(cmd, log_file, cwd, env, timeout, write_fd))
+        with os.fdopen(read_fd, 'rb') as stream:
+            try:
+                consumer(stream)
+            except BaseException:
+                future.cancel()  # Stops the process
+                raise
+        returncode = future.result()
+        if returncode != 0:
+            raise Exception('{} exited with code {}. See {}'.format(os.path.basename(cmd[0]), returncode, log_file))
+
+    @staticmethod
+    def start(cmd, log_file, cwd=None, env=None, on_line=None):
+        # Long running process (e.g. a basecall server), returns right away
+        process, task = ProcessManager.submit(ProcessManager.spawn(cmd, log_file, cwd, env, None, on_line)).result()
+        return ManagedProcess(process, task)
+
+    @staticmethod
+    def cancel_all():
+        # Stop every child still running, e.g. on Ctrl-C or when a stage fails
+        if ProcessManager.loop is None:
+            return
+
+        async def stop_all():
+            await asyncio.gather(*[ProcessManager.stop(p) for p in list(ProcessManager.running)])
+
+        ProcessManager.submit(stop_all()).result()
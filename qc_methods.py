@@ -0,0 +1,170 @@
+import json
+import numpy as np
+from summary_methods import SummaryMethods
+
+
+class QcAccumulator(object):
+    # Running totals for one group of reads (whole run or one barcode). Memory only depends on the number of distinct
+    # read lengths and on the run duration, never on the number of reads.
+    qscore_bins = np.arange(0, 50.5, 0.5)
+    # 20 log-spaced bins per decade, up to 10 Mb (longer reads go to the last bin)
+    length_bins = np.concatenate([[0], np.unique(np.logspace(0, 7, 141).astype(np.int64))])
+    time_bin = 600  # seconds
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.pass_reads = 0
+        self.pass_bases = 0
+        # Exact read count per distinct length (sorted), for the N50 and the length histogram
+        self.length_values = np.zeros(0, dtype=np.int64)
+        self.length_counts = np.zeros(0, dtype=np.int64)
+        self.qscore_hist = np.zeros(len(QcAccumulator.qscore_bins) - 1, dtype=np.int64)
+        self.time_yield = np.zeros(1, dtype=np.int64)
+
+    @staticmethod
+    def add_padded(total, values):
+        if len(values) > len(total):
+            total = np.pad(total, (0, len(values) - len(total)))
+        total[:len(values)] += values
+        return total
+
+    def add_lengths(self, lengths):
+        values, counts = np.unique(lengths, return_counts=True)
+        values, inverse = np.unique(np.concatenate([self.length_values, values]), return_inverse=True)
+        self.length_counts = np.bincount(inverse, weights=np.concatenate([self.length_counts, counts]),
+                                         minlength=len(values)).astype(np.int64)
+        self.length_values = values
+
+    def add(self, chunk, run_start):
+        lengths = chunk['sequence_length_template'].astype(np.int64)
+        passes = chunk['passes_filtering']
+        self.reads += len(chunk)
+        self.bases += int(lengths.sum())
+        self.pass_reads += int(passes.sum())
+        self.pass_bases += int(lengths[passes].sum())
+        self.add_lengths(lengths)
+        self.qscore_hist += np.histogram(np.clip(chunk['mean_qscore_template'], 0, 49.99),
+                                         bins=QcAccumulator.qscore_bins)[0]
+        time_idx = ((chunk['start_time'] - run_start) // QcAccumulator.time_bin).astype(np.int64)
+        self.time_yield = QcAccumulator.add_padded(self.time_yield,
+                                                   np.bincount(np.maximum(time_idx, 0), weights=lengths)
+                                                   .astype(np.int64))
+
+    def n50(self):
+        if not self.bases:
+            return 0
+        # Cumulative yield from the longest read down
+        cum_bases = np.cumsum((self.length_values * self.length_counts)[::-1])
+        return int(self.length_values[::-1][np.searchsorted(cum_bases, self.bases / 2)])
+
+    def length_histogram(self):
+        # Without the empty bins at either end
+        if not self.reads:
+            return {'bins': [], 'counts': []}
+        hist = np.histogram(np.minimum(self.length_values, QcAccumulator.length_bins[-1] - 1),
+                            bins=QcAccumulator.length_bins, weights=self.length_counts)[0].astype(np.int64)
+        used = np.flatnonzero(hist)
+        first, last = used[0], used[-1] + 1
+        return {'bins': QcAccumulator.length_bins[first:last + 1].tolist(), 'counts': hist[first:last].tolist()}
+
+    def to_dict(self):
+        return {'reads': self.reads,
+                'bases': self.bases,
+                'pass_reads': self.pass_reads,
+                'pass_bases': self.pass_bases,
+                'n50': self.n50(),
+                'mean_length': round(self.bases / self.reads, 1) if self.reads else 0,
+                'length_histogram': self.length_histogram(),
+                'qscore_histogram': {'bins': QcAccumulator.qscore_bins.tolist(),
+                                     'counts': self.qscore_hist.tolist()},
+                'yield_over_time': {'bin_seconds': QcAccumulator.time_bin,
+                                    'cumulative_bases': np.cumsum(self.time_yield).tolist()}}
+
+
+class QcMethods(object):
+    chunk_size = 1000000  # rows
+
+    @staticmethod
+    def group_name(partition):
+        # "barcode01_pass" -> "barcode01". Non-barcoded runs only have "pass" and "fail".
+        if partition in ('pass', 'fail'):
+            return 'all'
+        return partition.rsplit('_', 1)[0]
+
+    @staticmethod
+    def iter_chunks(table):
+        for i in range(0, len(table), QcMethods.chunk_size):
+            yield table[i:i + QcMethods.chunk_size]
+
+    @staticmethod
+    def compute(partition_folder):
+        names = SummaryMethods.list_partitions(partition_folder)
+
+        # First pass only touches the (memory mapped) start_time column
+        run_start = None
+        for name in names:
+            table, meta = SummaryMethods.load_partition(partition_folder, name)
+            if len(table):
+                t0 = float(table['start_time'].min())
+                run_start = t0 if run_start is None else min(run_start, t0)
+
+        run = QcAccumulator()
+        groups = dict()
+        for name in names:
+            group = groups.setdefault(QcMethods.group_name(name), QcAccumulator())
+            table, meta = SummaryMethods.load_partition(partition_folder, name)
+            for chunk in QcMethods.iter_chunks(table):
+                run.add(chunk, run_start)
+                group.add(chunk, run_start)
+
+        report = run.to_dict()
+        report['barcodes'] = {g: acc.to_dict() for g, acc in sorted(groups.items())}
+        return report
+
+    @staticmethod
+    def write_html(report, html_file):
+        def table(rows, header):
+            out = '<table><tr>' + ''.join('<th>{}</th>'.format(h) for h in header) + '</tr>'
+            for row in rows:
+                out += '<tr>' + ''.join('<td>{}</td>'.format(c) for c in row) + '</tr>'
+            return out + '</table>'
+
+        def bars(labels, counts):
+            top = max(counts) if counts and max(counts) else 1
+            rows = [(label, '<div style="background:#4a7ebb;height:10px;width:{}px"></div>'.format(
+                int(300 * c / top)), c) for label, c in zip(labels, counts)]
+            return table(rows, ['bin', '', 'count'])
+
+        summary_keys = ['reads', 'bases', 'pass_reads', 'pass_bases', 'n50', 'mean_length']
+        length_hist = report['length_histogram']
+        qscore_hist = report['qscore_histogram']
+        time_yield = report['yield_over_time']
+
+        html = ['<html><head><meta charset="utf-8"><title>Read QC</title><style>'
+                'body{font-family:sans-serif}td,th{padding:2px 8px;text-align:right}</style></head><body>',
+                '<h1>Read QC</h1>',
+                table([[k, report[k]] for k in summary_keys], ['metric', 'value']),
+                '<h2>Per barcode</h2>',
+                table([[g] + [b[k] for k in summary_keys] for g, b in report['barcodes'].items()],
+                      ['barcode'] + summary_keys),
+                '<h2>Read length</h2>',
+                bars(['{}-{}'.format(a, b) for a, b in zip(length_hist['bins'], length_hist['bins'][1:])],
+                     length_hist['counts']),
+                '<h2>Mean qscore</h2>',
+                bars(qscore_hist['bins'][:-1], qscore_hist['counts']),
+                '<h2>Cumulative yield over time</h2>',
+                bars(['{} h'.format(round(i * time_yield['bin_seconds'] / 3600, 2))
+                      for i in range(len(time_yield['cumulative_bases']))], time_yield['cumulative_bases']),
+                '</body></html>']
+
+        with open(html_file, 'w') as f:
+            f.write('\n'.join(html))
+
+    @staticmethod
+    def make_report(qc_folder):
+        report = QcMethods.compute(qc_folder + 'summary/')
+        with open(qc_folder + 'qc_report.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        QcMethods.write_html(report, qc_folder + 'qc_report.html')
+        return report
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import socket
+import resource
+import threading
+from contextlib import contextmanager
+import psutil
+
+
+class RunReport(object):
+    # Machine-readable timing/resource report, one entry per stage, written to "run_report.json"
+    sample_interval = 1  # seconds between two samples of the children
+    # Stages open in this process, over all the reports (batch mode runs post-processing and basecalling at once)
+    open_stages = set()
+    lock = threading.Lock()
+
+    def __init__(self, report_file, settings):
+        self.report_file = report_file
+        self.report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'host': {'name': socket.gethostname(),
+                                'cpu': psutil.cpu_count(),
+                                'memory_gb': round(psutil.virtual_memory().total / 1e9, 1)},
+                       'settings': settings,
+                       'versions': dict(),
+                       'stages': list()}
+        self.process = psutil.Process()
+        self.readings = dict()  # Latest readings of the stages open in this report
+
+    def read_usage(self, readings):
+        # CPU seconds, bytes read and written of this process and of all its descendants. Children that exited and
+        # were waited for are in "RUSAGE_CHILDREN", in full. The others are read from /proc while alive: the pool
+        # workers are children of the forkserver, so they never show up in "RUSAGE_CHILDREN". "readings" keeps the
+        # last values of every process seen, so a grandchild that exits between two samples still counts.
+        # Returns the RSS of the descendants and the processes alive.
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        readings['waited'] = (children.ru_utime + children.ru_stime, children.ru_inblock * 512,
+                              children.ru_oublock * 512, False)
+        rss = 0
+        alive = {'waited'}
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.Error:
+            processes = [self.process]
+        for process in processes:
+            try:
+                with process.oneshot():
+                    key = (process.pid, process.create_time())
+                    direct = process.ppid() == self.process.pid
+                    times = process.cpu_times()
+                    io = process.io_counters()
+                    if process is not self.process:
+                        rss += process.memory_info().rss
+            except psutil.Error:
+                continue  # Exited
+            readings[key] = (times.user + times.system, io.read_bytes, io.write_bytes, direct)
+            alive.add(key)
+        return rss, alive
+
+    @staticmethod
+    def usage_delta(start, end, alive):
+        # Processes started during the stage count from zero. Direct children gone by the end were waited for, they
+        # are in "waited".
+        totals = [0.0, 0, 0]
+        for key, values in end.items():
+            if key not in alive and values[3]:
+                continue
+            for i, (value, start_value) in enumerate(zip(values[:3], start.get(key, (0, 0, 0)))):
+                totals[i] += value - start_value
+        return totals
+
+    @contextmanager
+    def stage(self, name):
+        # Yields a dict the caller can fill with "reads", "bases" or anything else worth keeping
+        stage = {'name': name}
+        peak = [0]
+        overlap = [False]
+        stop = threading.Event()
+        start_usage = dict()
+        end_usage = dict()
+        self.read_usage(start_usage)
+        self.readings[id(stage)] = end_usage
+
+        def sampler():
+            while not stop.is_set():
+                peak[0] = max(peak[0], self.read_usage(end_usage)[0])
+                with RunReport.lock:
+                    overlap[0] = overlap[0] or len(RunReport.open_stages) > 1
+                stop.wait(RunReport.sample_interval)
+
+        thread = threading.Thread(target=sampler, daemon=True)
+        start_wall = time.time()
+        with RunReport.lock:
+            RunReport.open_stages.add(id(stage))
+        thread.start()
+        try:
+            yield stage
+        finally:
+            stop.set()
+            thread.join()
+            with RunReport.lock:
+                RunReport.open_stages.discard(id(stage))
+            self.readings.pop(id(stage), None)
+            wall = time.time() - start_wall
+            _, alive = self.read_usage(end_usage)
+            cpu, read_bytes, write_bytes = RunReport.usage_delta(start_usage, end_usage, alive)
+            stage.update({'wall_seconds': round(wall, 3),
+                          'cpu_seconds': round(cpu, 3),
+                          'peak_children_rss_bytes': peak[0],
+                          'bytes_read': read_bytes,
+                          'bytes_written': write_bytes})
+            if overlap[0]:
+                # Another run of the batch was going on in this process at the same time, its usage is included.
+                # The per-task numbers ("tasks") only count this run.
+                stage['shared_process'] = True
+            for unit in ['reads', 'bases']:
+                if stage.get(unit) and wall > 0:
+                    stage[unit + '_per_second'] = round(stage[unit] / wall, 1)
+            self.report['stages'].append(stage)
+            self.write()
+
+    def sample(self):
+        # Reading outside the periodic ones, e.g. right before a process pool shuts down: what its workers used since
+        # the last sample would be lost with them
+        for readings in list(self.readings.values()):
+            self.read_usage(readings)
+
+    def add_versions(self, versions):
+        self.report['versions'].update(versions)
+
+    def write(self):
+        self.report['max_children_rss_bytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        tmp_file = self.report_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.report, f, indent=2)
+        os.replace(tmp_file, self.report_file)
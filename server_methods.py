@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import signal
+import psutil
+from basecall_nanopore_dorado_methods import Methods
+
+
+class ServerMethods(object):
+    # Servers started by this pipeline are recorded here so a later invocation can find and reuse them
+    state_folder = os.path.join(os.path.expanduser('~'), '.cache', 'basecall_nanopore_dorado', 'servers') + '/'
+
+    @staticmethod
+    def state_file(port):
+        return ServerMethods.state_folder + 'server_{}.json'.format(port)
+
+    @staticmethod
+    def is_server_process(pid, port):
+        # The recorded server may have died and its pid been reused by an unrelated process: only a basecall server
+        # listening on that port counts. A process of another user is not one of ours either.
+        try:
+            process = psutil.Process(pid)
+            cmdline = process.cmdline()
+            if process.uids().real != os.getuid():
+                return False
+        except psutil.Error:
+            return False
+        name = os.path.basename(Methods.server_bin)
+        ports = [cmdline[i + 1] for i in range(len(cmdline) - 1) if cmdline[i] == '--port']
+        # Interpreted servers (e.g. the stubs) have the script second
+        return any(os.path.basename(x) == name for x in cmdline[:2]) and str(port) in ports
+
+    @staticmethod
+    def terminate(pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass  # Exited in the meantime
+
+    @staticmethod
+    def read_state(port):
+        try:
+            with open(ServerMethods.state_file(port), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_state(server):
+        Methods.make_folder(ServerMethods.state_folder)
+        state = {k: server[k] for k in ['pid', 'port', 'config', 'device', 'log_path']}
+        with open(ServerMethods.state_file(server['port']), 'w') as f:
+            json.dump(state, f)
+
+    @staticmethod
+    def remove_state(port):
+        if os.path.exists(ServerMethods.state_file(port)):
+            os.remove(ServerMethods.state_file(port))
+
+    @staticmethod
+    def wait_for_port(port, timeout, process=None):
+        # Loading the model takes a while. Only start clients once the server accepts connections.
+        start = time.time()
+        while not Methods.is_basecall_server_running(port):
+            if process is not None and process.poll() is not None:
+                raise Exception('Basecall server on port {} exited with code {} before being ready.'
+                                .format(port, process.returncode))
+            if time.time() - start > timeout:
+                raise Exception('Basecall server on port {} not ready after {} seconds.'.format(port, timeout))
+            time.sleep(1)
+
+    @staticmethod
+    def find_server(config, device, port):
+        # Return the recorded server on that port if it is alive, listening and running the same config on the same
+        # device. A server of ours with another config is stopped so the port can be reused.
+        state = ServerMethods.read_state(port)
+        if not state:
+            return None
+        if not ServerMethods.is_server_process(state['pid'], port):
+            ServerMethods.remove_state(port)  # Stale
+            return None
+        if state['config'] == config and state['device'] == device and Methods.is_basecall_server_running(port):
+            return state
+        print('\tStopping basecall server on port {} ({} on {})'.format(port, state['config'], state['device']))
+        ServerMethods.stop_server(port)
+        return None
+
+    @staticmethod
+    def get_server(basecalled_folder, config, port, device, timeout, keep):
+        server = ServerMethods.find_server(config, device, port)
+        if server:
+            print('\tReusing basecall server on port {} (pid {})'.format(port, server['pid']))
+            server.update({'process': None, 'reused': True})
+            return server
+
+        if Methods.is_basecall_server_running(port):
+            raise Exception('Port {} is already used by another process. Please choose another port.'.format(port))
+
+        # A server kept between runs logs in the cache folder, not in the output of the run that started it
+        if keep:
+            log_path = ServerMethods.state_folder + 'logs_{}'.format(port)
+        else:
+            log_path = basecalled_folder + '/logs/server_' + str(port)
+        p = Methods.start_dorado_basecall_server(basecalled_folder, config, port, device, log_path, detach=keep)
+        server = {'pid': p.pid, 'port': port, 'config': config, 'device': device, 'log_path': log_path,
+                  'process': p, 'reused': False}
+        ServerMethods.write_state(server)
+        try:
+            ServerMethods.wait_for_port(port, timeout, p)
+        except Exception:
+            ServerMethods.release_server(server, False)
+            raise
+        return server
+
+    @staticmethod
+    def release_server(server, keep):
+        if keep:
+            return
+        if server['process'] is not None:
+            server['process'].terminate()
+            server['process'].wait()
+        elif ServerMethods.is_server_process(server['pid'], server['port']):
+            ServerMethods.terminate(server['pid'])
+        ServerMethods.remove_state(server['port'])
+
+    @staticmethod
+    def stop_server(port):
+        state = ServerMethods.read_state(port)
+        if state and ServerMethods.is_server_process(state['pid'], port):
+            ServerMethods.terminate(state['pid'])
+            # Give it a few seconds to release the port
+            for _ in range(30):
+                if not ServerMethods.is_server_process(state['pid'], port):
+                    break
+                time.sleep(0.5)
+        ServerMethods.remove_state(port)
@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import heapq
+import queue
+import shutil
+import threading
+from glob import glob
+from basecall_nanopore_dorado_methods import Methods
+from ledger_methods import LedgerMethods
+from prefetch_methods import RawPrefetcher
+
+
+class ShardMethods(object):
+    # Shards per server. More shards than servers lets a fast server pick up the work of a slow one.
+    shards_per_server = 4
+
+    @staticmethod
+    def parse_servers(gpu, port):
+        # "cuda:0,cuda:1" and "5555" -> [('cuda:0', 5555), ('cuda:1', 5556)]
+        devices = [x.strip() for x in gpu.split(',') if x.strip()]
+        ports = [int(x) for x in str(port).split(',') if x.strip()]
+        while len(ports) < len(devices):
+            ports.append(ports[-1] + 1)
+        return list(zip(devices, ports))
+
+    @staticmethod
+    def make_shards(raw_files, n_shards):
+        # Size-balanced shards (largest file first into the lightest shard). raw_files is a path -> (size, mtime) dict.
+        n_shards = max(1, min(n_shards, len(raw_files)))
+        heap = [(0, i) for i in range(n_shards)]
+        shards = [list() for _ in range(n_shards)]
+        for path, (size, mtime) in sorted(raw_files.items(), key=lambda x: x[1][0], reverse=True):
+            total, i = heapq.heappop(heap)
+            shards[i].append(path)
+            heapq.heappush(heap, (total + size, i))
+
+        # Heaviest shards first
+        return [sorted(x) for x in sorted(shards, key=lambda x: sum(raw_files[p][0] for p in x), reverse=True) if x]
+
+    @staticmethod
+    def collect_shard(shard_folder, basecalled_folder, shard_name):
+        # Move the shard's chunks into "1_basecalled/pass|fail/<barcode>/", prefixed so they do not collide with
+        # chunks from other shards. They are merged afterwards like regular chunks.
+        for i in ['pass', 'fail']:
+            for chunk in glob(shard_folder + i + '/**/fastq_runid_*.fastq.gz', recursive=True):
+                sub_folder = os.path.relpath(os.path.dirname(chunk), shard_folder + i)
+                out_folder = os.path.normpath(basecalled_folder + i + '/' + sub_folder) + '/'
+                Methods.make_folder(out_folder)
+                new_name = os.path.basename(chunk).replace('fastq_runid_', 'fastq_runid_' + shard_name + '_', 1)
+                os.replace(chunk, out_folder + new_name)
+
+    @staticmethod
+    def basecall_shard(shard, shard_name, basecalled_folder, dorado_conf, recursive, device, barcode_kit,
+                       min_qscore, port):
+        shard_folder = basecalled_folder + 'shards/' + shard_name + '/'
+        Methods.make_folder(shard_folder)
+        file_list = shard_folder + 'input_files.txt'
+        Methods.list_to_file([os.path.basename(x) for x in shard], file_list)
+
+        input_folder = os.path.commonpath([os.path.dirname(x) for x in shard])
+        return Methods.run_dorado(input_folder, shard_folder, dorado_conf, recursive, device, barcode_kit,
+                                  min_qscore, port, input_file_list=file_list,
+                                  log_file=basecalled_folder + 'logs/' + shard_name + '.log', name=shard_name)
+
+    @staticmethod
+    def finish_shard(basecalled_folder, shard_name):
+        # Once the shard is in the ledger
+        shard_folder = basecalled_folder + 'shards/' + shard_name + '/'
+        ShardMethods.collect_shard(shard_folder, basecalled_folder, shard_name)
+        shutil.rmtree(shard_folder)
+
+    @staticmethod
+    def recover_shards(basecalled_folder, ledger_file):
+        # After an interrupted run: the shards in the ledger are collected (they may have been stopped in the
+        # middle), the others are basecalled again, so their outputs and any of their chunks already moved go.
+        done = {chunk for _, _, chunk in LedgerMethods.load(ledger_file).values()}
+        for shard_folder in glob(basecalled_folder + 'shards/*/'):
+            shard_name = os.path.basename(os.path.normpath(shard_folder))
+            if shard_name in done:
+                ShardMethods.finish_shard(basecalled_folder, shard_name)
+        shutil.rmtree(basecalled_folder + 'shards', ignore_errors=True)
+        for i in ['pass', 'fail']:
+            for chunk in glob(basecalled_folder + i + '/**/fastq_runid_shard_*.fastq.gz', recursive=True):
+                match = re.match(r'fastq_runid_(shard_\d+_\d+)_', os.path.basename(chunk))
+                if match and match.group(1) not in done:
+                    os.remove(chunk)
+
+    @staticmethod
+    def run_shards(raw_files, servers, basecalled_folder, dorado_conf, recursive, barcode_kit, min_qscore,
+                   ledger_file, max_files, prefetch_folder=None, prefetch_depth=0, prefetch_bytes=0):
+        # One worker thread per server, all pulling from the same shard queue. Shards hold at most "max_files" files
+        # so an interrupted run only loses the shards in progress (see ledger).
+        # With "prefetch_depth", the raw files of the next shards are copied to "prefetch_folder" ahead of the clients
+        # (see RawPrefetcher). Shards are then made small enough for "prefetch_bytes" to hold the shards being
+        # basecalled and the prefetched ones.
+        ShardMethods.recover_shards(basecalled_folder, ledger_file)
+        n_shards = max(len(servers) * ShardMethods.shards_per_server, -(-len(raw_files) // max_files))
+        if prefetch_depth:
+            n_shards = max(n_shards, RawPrefetcher.shard_target(sum(size for size, _ in raw_files.values()),
+                                                                len(servers), prefetch_depth, prefetch_bytes))
+        shards = ShardMethods.make_shards(raw_files, n_shards)
+        # Shard names must not collide with the chunks left by a previous attempt
+        attempt = int(time.time())
+        shards = [('shard_{}_{:04d}'.format(attempt, i), shard) for i, shard in enumerate(shards)]
+        work = queue.Queue()
+        for shard in shards:
+            work.put(shard)
+        prefetcher = None
+        if prefetch_depth and shards:
+            prefetcher = RawPrefetcher(shards, raw_files, prefetch_folder, prefetch_depth, prefetch_bytes).start()
+
+        errors = list()
+        totals = {'reads': 0, 'bases': 0}  # From the clients' progress reports
+        lock = threading.Lock()
+
+        def worker(device, port):
+            while not errors:
+                try:
+                    shard_name, shard = work.get_nowait()
+                except queue.Empty:
+                    return
+                print('\t{} ({} files) -> {} (port {})'.format(shard_name, len(shard), device, port))
+                try:
+                    # The prefetched copies are in a flat folder
+                    inputs = prefetcher.get(shard_name) if prefetcher else shard
+                    progress = ShardMethods.basecall_shard(inputs, shard_name, basecalled_folder, dorado_conf,
+                                                           recursive, device, barcode_kit, min_qscore, port)
+                    # Ledger first: a shard in the ledger is collected on resume if interrupted while moving its
+                    # chunks, while chunks of a shard missing from it would be basecalled twice
+                    LedgerMethods.record(ledger_file, {path: raw_files[path] for path in shard}, shard_name)
+                    ShardMethods.finish_shard(basecalled_folder, shard_name)
+                    with lock:
+                        totals['reads'] += progress.reads
+                        totals['bases'] += progress.bases
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    if prefetcher:
+                        prefetcher.release(shard_name)
+
+        threads = [threading.Thread(target=worker, args=server) for server in servers]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if prefetcher:
+                prefetcher.close()
+                totals['prefetch'] = prefetcher.stats
+        if errors:
+            raise errors[0]
+
+        shutil.rmtree(basecalled_folder + 'shards', ignore_errors=True)
+        return totals
@@ -0,0 +1,150 @@
+import os
+import time
+import zlib
+import shutil
+import hashlib
+import threading
+from glob import glob
+from concurrent import futures
+
+
+class StagingMethods(object):
+    # Disk space estimates, from the size of the raw data. They err on the high side.
+    fastq_ratio = 0.2  # fastq.gz bytes per raw (pod5/fast5) byte
+    scratch_copies = 3  # Client chunks and merged fastq during merging, then filtered fastq
+    output_copies = 2  # Merged and filtered fastq
+    copy_chunk = 16 * 1024 * 1024
+
+    @staticmethod
+    def work_folder(scratch, output_folder):
+        # One folder per output folder, so the runs of a batch do not share their scratch space
+        output_folder = os.path.abspath(output_folder)
+        key = hashlib.sha1(output_folder.encode()).hexdigest()[:8]
+        return os.path.join(os.path.abspath(scratch), '{}_{}'.format(os.path.basename(output_folder), key))
+
+    @staticmethod
+    def free_space(folder):
+        # Closest existing parent, the folder itself may not be created yet
+        while not os.path.exists(folder):
+            folder = os.path.dirname(folder)
+        return shutil.disk_usage(folder).free, os.stat(folder).st_dev
+
+    @staticmethod
+    def check_free_space(raw_bytes, scratch_folder, output_folder, cache_bytes=0):
+        # "cache_bytes": raw files prefetched to the scratch folder (see RawPrefetcher)
+        fastq_bytes = raw_bytes * StagingMethods.fastq_ratio
+        scratch_free, scratch_dev = StagingMethods.free_space(scratch_folder)
+        output_free, output_dev = StagingMethods.free_space(output_folder)
+        scratch_needed = fastq_bytes * StagingMethods.scratch_copies + min(cache_bytes, raw_bytes)
+        output_needed = fastq_bytes * StagingMethods.output_copies
+        if scratch_dev == output_dev:
+            scratch_needed += output_needed
+            output_needed = scratch_needed
+        for name, folder, free, needed in [('scratch', scratch_folder, scratch_free, scratch_needed),
+                                           ('output', output_folder, output_free, output_needed)]:
+            if free < needed:
+                raise Exception('Not enough free space in the {} folder {}: about {:.1f} GB needed for {:.1f} GB of '
+                                'raw data, {:.1f} GB free.'.format(name, folder, needed / 1e9, raw_bytes / 1e9,
+                                                                   free / 1e9))
+
+    @staticmethod
+    def checksum(path):
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(StagingMethods.copy_chunk)
+                if not data:
+                    return crc
+                crc = zlib.crc32(data, crc)
+
+    @staticmethod
+    def copy_verified(src, dst):
+        # Copy through a temporary file, read it back and compare checksums before putting it in place
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp_file = dst + '.tmp'
+        crc = 0
+        with open(src, 'rb') as fin, open(tmp_file, 'wb') as fout:
+            while True:
+                data = fin.read(StagingMethods.copy_chunk)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if os.path.getsize(tmp_file) != os.path.getsize(src) or StagingMethods.checksum(tmp_file) != crc:
+            os.remove(tmp_file)
+            raise Exception('Copy of {} to {} is corrupted.'.format(src, dst))
+        shutil.copystat(src, tmp_file)  # Keeps the mtime, the sidecar indexes compare them
+        os.replace(tmp_file, dst)
+        return os.path.getsize(dst)
+
+    @staticmethod
+    def stage_in(output_folder, work_folder, patterns):
+        # Resumed run whose scratch copy is gone: bring back the outputs of the stages already done
+        copied = 0
+        for pattern in patterns:
+            for path in glob(os.path.join(output_folder, pattern), recursive=True):
+                target = os.path.join(work_folder, os.path.relpath(path, output_folder))
+                if os.path.isfile(path) and not os.path.exists(target):
+                    copied += StagingMethods.copy_verified(path, target)
+        return copied
+
+
+class WriteBack(object):
+    # Copies finished files from the scratch folder to the output folder in the background, a few at a time, while
+    # the pipeline goes on. Paths keep their place relative to the work folder. Without scratch (same folders),
+    # nothing is copied.
+    workers = 4
+
+    def __init__(self, work_folder, output_folder):
+        self.work_folder = os.path.abspath(work_folder)
+        self.output_folder = os.path.abspath(output_folder)
+        self.enabled = self.work_folder != self.output_folder
+        self.executor = futures.ThreadPoolExecutor(max_workers=WriteBack.workers) if self.enabled else None
+        self.jobs = list()
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def target(self, path):
+        return os.path.join(self.output_folder, os.path.relpath(os.path.abspath(path), self.work_folder))
+
+    def copy(self, path):
+        start = time.time()
+        size = StagingMethods.copy_verified(path, self.target(path))
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+            self.stats['seconds'] = round(self.stats['seconds'] + time.time() - start, 3)
+
+    def submit(self, *paths):
+        # Returns the jobs, to wait for some files in particular (see "wait")
+        if not self.enabled:
+            return list()
+        jobs = [self.executor.submit(self.copy, path) for path in paths if os.path.isfile(path)]
+        with self.lock:
+            self.jobs.extend(jobs)
+        return jobs
+
+    def submit_folder(self, folder):
+        return self.submit(*[x for x in glob(os.path.join(folder, '**', '*'), recursive=True) if os.path.isfile(x)])
+
+    def wait(self, jobs=None):
+        # All the copies submitted so far (including the ones submitted while waiting) or only "jobs"
+        if jobs is not None:
+            for job in jobs:
+                job.result()  # Propagate errors
+            return
+        done = 0
+        while True:
+            with self.lock:
+                jobs = self.jobs[done:]
+            if not jobs:
+                break
+            for job in jobs:
+                job.result()
+            done += len(jobs)
+
+    def shutdown(self):
+        if self.enabled:
+            self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,133 @@
+import os
+import json
+from glob import glob
+from datetime import datetime
+from array import array
+import numpy as np
+from fastq_methods import FastqMethods
+from index_methods import IndexMethods
+
+
+class SummaryMethods(object):
+    # One row per read. Run ids and barcodes are stored as codes into the partition's metadata lists.
+    summary_dtype = np.dtype([('read_id', 'S36'),
+                              ('run_id', np.uint16),
+                              ('channel', np.uint16),
+                              ('start_time', np.float64),  # Epoch, in seconds
+                              ('sequence_length_template', np.uint32),
+                              ('mean_qscore_template', np.float32),
+                              ('passes_filtering', np.bool_),
+                              ('barcode_arrangement', np.uint16)])
+
+    tsv_columns = ['read_id', 'run_id', 'channel', 'start_time', 'sequence_length_template',
+                   'mean_qscore_template', 'passes_filtering', 'barcode_arrangement']
+
+    @staticmethod
+    def parse_header(header):
+        # @read_id runid=xxx sampleid=xxx read=123 ch=456 start_time=2024-01-01T00:00:00.000+00:00 barcode=barcode01
+        fields = header[1:].decode().split()
+        tags = dict(f.split('=', 1) for f in fields[1:] if '=' in f)
+        return fields[0], tags
+
+    @staticmethod
+    def to_epoch(timestamp):
+        if not timestamp:
+            return 0.0
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+    @staticmethod
+    def list_merged_fastq(basecalled_folder):
+        # Merged files only, not the "fastq_runid_*" chunks
+        fastq_list = list()
+        for i in ['pass', 'fail']:
+            for fastq in glob(basecalled_folder + i + '/**/*.fastq.gz', recursive=True):
+                if not os.path.basename(fastq).startswith('fastq_runid_'):
+                    fastq_list.append(fastq)
+        return sorted(fastq_list)
+
+    @staticmethod
+    def partition_name(fastq):
+        # "barcode01_pass.fastq.gz" -> "barcode01_pass"
+        return os.path.basename(fastq).split('.')[0]
+
+    @staticmethod
+    def summarize_fastq(fastq, partition_folder):
+        passes = os.path.basename(fastq).split('.')[0].endswith('pass')
+        run_ids = dict()
+        barcodes = dict()
+        read_ids = list()
+        columns = {'run_id': array('H'), 'channel': array('H'), 'start_time': array('d'),
+                   'barcode_arrangement': array('H')}
+
+        # Lengths and qscores come from the sidecar index when it is up to date, only the headers are parsed then
+        index = IndexMethods.load_index(fastq)
+        lengths = list()
+        qscores = list()
+        for batch in FastqMethods.iter_batches(fastq, stats=index is None):
+            for header in batch.headers():
+                read_id, tags = SummaryMethods.parse_header(header)
+                read_ids.append(read_id)
+                columns['run_id'].append(run_ids.setdefault(tags.get('runid', ''), len(run_ids)))
+                columns['channel'].append(int(tags.get('ch', 0)))
+                columns['start_time'].append(SummaryMethods.to_epoch(tags.get('start_time')))
+                columns['barcode_arrangement'].append(barcodes.setdefault(tags.get('barcode', 'unclassified'),
+                                                                          len(barcodes)))
+            if index is None:
+                lengths.append(batch.lengths)
+                qscores.append(batch.qscores)
+
+        table = np.zeros(len(read_ids), dtype=SummaryMethods.summary_dtype)
+        table['read_id'] = read_ids
+        for column, values in columns.items():
+            table[column] = values
+        if index is not None:
+            if len(index) != len(table):
+                raise Exception('The index of {} does not match the fastq. Delete {} and try again.'.format(
+                    fastq, IndexMethods.index_file(fastq)))
+            table['sequence_length_template'] = index['length']
+            table['mean_qscore_template'] = index['qscore']
+        elif lengths:
+            table['sequence_length_template'] = np.concatenate(lengths)
+            table['mean_qscore_template'] = np.concatenate(qscores)
+        table['passes_filtering'] = passes
+
+        # Write the partition: a memory-mappable ".npy" table and a small ".json" with the code lists
+        name = SummaryMethods.partition_name(fastq)
+        np.save(partition_folder + name + '.npy', table)
+        with open(partition_folder + name + '.json', 'w') as f:
+            json.dump({'fastq': fastq, 'run_id': list(run_ids), 'barcode_arrangement': list(barcodes)}, f)
+
+        return name
+
+    @staticmethod
+    def load_partition(partition_folder, name, mmap=True):
+        table = np.load(partition_folder + name + '.npy', mmap_mode='r' if mmap else None)
+        with open(partition_folder + name + '.json', 'r') as f:
+            meta = json.load(f)
+        return table, meta
+
+    @staticmethod
+    def list_partitions(partition_folder):
+        return sorted(os.path.basename(x)[:-4] for x in glob(partition_folder + '*.npy'))
+
+    @staticmethod
+    def write_tsv(partition_folder, summary_file):
+        # pycoQC wants start_time relative to the beginning of the run
+        names = SummaryMethods.list_partitions(partition_folder)
+        run_start = None
+        for name in names:
+            table, meta = SummaryMethods.load_partition(partition_folder, name)
+            if len(table):
+                t0 = float(table['start_time'].min())
+                run_start = t0 if run_start is None else min(run_start, t0)
+
+        with open(summary_file, 'w') as f:
+            f.write('\t'.join(SummaryMethods.tsv_columns) + '\n')
+            for name in names:
+                table, meta = SummaryMethods.load_partition(partition_folder, name)
+                for row in table:
+                    f.write('{}\t{}\t{}\t{:.3f}\t{}\t{:.2f}\t{}\t{}\n'.format(
+                        row['read_id'].decode(), meta['run_id'][row['run_id']], row['channel'],
+                        row['start_time'] - run_start, row['sequence_length_template'],
+                        row['mean_qscore_template'], 'TRUE' if row['passes_filtering'] else 'FALSE',
+                        meta['barcode_arrangement'][row['barcode_arrangement']]))
@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+from glob import glob
+from basecall_nanopore_dorado_methods import Methods
+from merge_methods import MergeMethods
+from ledger_methods import LedgerMethods
+from inventory_methods import InventoryMethods
+
+
+class WatchMethods(object):
+    @staticmethod
+    def find_completed(current, previous, settle):
+        # A file is considered complete when it did not change between two polls and was not modified recently
+        now = time.time()
+        return sorted(path for path, (size, mtime) in current.items()
+                      if previous.get(path) == (size, mtime) and now - mtime >= settle)
+
+    @staticmethod
+    def is_run_finished(input_folder):
+        # MinKNOW writes a "final_summary_*.txt" file at the end of the run
+        return bool(glob(input_folder + '/**/final_summary_*.txt', recursive=True))
+
+    @staticmethod
+    def collect_batch(batch_folder, basecalled_folder):
+        # Append the chunks of a basecalled batch to the per-barcode outputs
+        # "batch/pass/barcode01/fastq_runid_*.fastq.gz" -> "1_basecalled/pass/barcode01/barcode01_pass.fastq.gz"
+        # "batch/pass/fastq_runid_*.fastq.gz" -> "1_basecalled/pass/pass.fastq.gz"
+        for i in ['pass', 'fail']:
+            chunk_dict = dict()
+            for chunk in glob(batch_folder + i + '/**/fastq_runid_*.fastq.gz', recursive=True):
+                chunk_dict.setdefault(os.path.relpath(os.path.dirname(chunk), batch_folder + i), list()).append(chunk)
+
+            for sub_folder, chunk_list in chunk_dict.items():
+                Methods.make_folder(os.path.normpath(basecalled_folder + i + '/' + sub_folder))
+                if sub_folder == '.':
+                    merged_fastq = basecalled_folder + i + '/' + i + '.fastq.gz'
+                else:
+                    merged_fastq = basecalled_folder + i + '/' + sub_folder + '/' + sub_folder + '_' + i + '.fastq.gz'
+                MergeMethods.append_files(chunk_list, merged_fastq)
+
+    @staticmethod
+    def basecall_batch(batch_files, batch_name, basecalled_folder, dorado_conf, recursive, gpu, barcode_kit,
+                       min_qscore, port):
+        batch_folder = basecalled_folder + 'batches/' + batch_name + '/'
+        Methods.make_folder(batch_folder)
+        file_list = batch_folder + 'input_files.txt'
+        Methods.list_to_file([os.path.basename(x) for x in batch_files], file_list)
+
+        # All the files of a batch share the same input folder when not recursive, but not necessarily otherwise
+        input_folder = os.path.commonpath([os.path.dirname(x) for x in batch_files])
+        Methods.run_dorado(input_folder, batch_folder, dorado_conf, recursive, gpu, barcode_kit, min_qscore, port,
+                           input_file_list=file_list, name=batch_name,
+                           log_file=basecalled_folder + 'logs/' + batch_name + '.log')
+
+    @staticmethod
+    def finish_batch(basecalled_folder, batch_name):
+        # Once the batch is in the ledger
+        batch_folder = basecalled_folder + 'batches/' + batch_name + '/'
+        WatchMethods.collect_batch(batch_folder, basecalled_folder)
+        shutil.rmtree(batch_folder)
+
+    @staticmethod
+    def recover_batches(basecalled_folder, ledger_file):
+        # After an interrupted run: the chunks of the batches in the ledger not appended yet are appended, the other
+        # batches are basecalled again (see ShardMethods.recover_shards)
+        done = {chunk for _, _, chunk in LedgerMethods.load(ledger_file).values()}
+        for batch_folder in glob(basecalled_folder + 'batches/*/'):
+            batch_name = os.path.basename(os.path.normpath(batch_folder))
+            if batch_name in done:
+                WatchMethods.finish_batch(basecalled_folder, batch_name)
+        shutil.rmtree(basecalled_folder + 'batches', ignore_errors=True)
+
+    @staticmethod
+    def watch(input_folder, basecalled_folder, dorado_conf, recursive, gpu, barcode_kit, min_qscore, port,
+              poll_interval, watch_timeout, batch_size, ledger_file, inventory_file):
+        # Basecall raw files as soon as they are complete, until the run is finished (or no new file for a while)
+        WatchMethods.recover_batches(basecalled_folder, ledger_file)
+        done = set(LedgerMethods.load(ledger_file))
+        previous = dict()
+        batch_number = 0
+        # Batch names must not collide with the batches of a previous attempt
+        attempt = int(time.time())
+        last_activity = time.time()
+
+        while True:
+            finished = WatchMethods.is_run_finished(input_folder)
+            current = InventoryMethods.raw_files(InventoryMethods.get_inventory(input_folder, recursive,
+                                                                                inventory_file))
+            if finished:
+                # No file is being written anymore
+                todo = sorted(set(current) - done)
+            else:
+                todo = [x for x in WatchMethods.find_completed(current, previous, poll_interval) if x not in done]
+            previous = current
+
+            for i in range(0, len(todo), batch_size):
+                batch = todo[i:i + batch_size]
+                batch_number += 1
+                batch_name = 'batch_{}_{:05d}'.format(attempt, batch_number)
+                print('\tBasecalling batch {} ({} files)'.format(batch_number, len(batch)))
+                WatchMethods.basecall_batch(batch, batch_name, basecalled_folder, dorado_conf, recursive, gpu,
+                                            barcode_kit, min_qscore, port)
+                # Ledger first: a batch in the ledger is appended on resume if interrupted while appending, while a
+                # batch missing from it would be appended twice
+                LedgerMethods.record(ledger_file, {path: current[path] for path in batch}, batch_name)
+                WatchMethods.finish_batch(basecalled_folder, batch_name)
+                done.update(batch)
+                last_activity = time.time()
+
+            if finished and not set(current) - done:
+                print('\tRun finished, all raw files basecalled')
+                break
+            if time.time() - last_activity > watch_timeout * 60:
+                print('\tNo new raw file for {} minutes, stopping'.format(watch_timeout))
+                break
+            time.sleep(poll_interval)
+
+        shutil.rmtree(basecalled_folder + 'batches', ignore_errors=True)
@@ -0,0 +1,59 @@
+import os
+import csv
+import pickle
+
+
+class WorkflowMethods(object):
+    # Compiled (flowcell, kit) -> config names lookup, rebuilt only when workflows.tsv changes
+    cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'basecall_nanopore_dorado') + '/'
+    index = None
+
+    @staticmethod
+    def build_index(workflows):
+        index = dict()
+        with open(workflows, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                index.setdefault((row['flowcell'], row['kit']), list()).append(row['config_name'])
+        return index
+
+    @staticmethod
+    def signature(workflows):
+        stat = os.stat(workflows)
+        return [os.path.abspath(workflows), stat.st_size, stat.st_mtime]
+
+    @staticmethod
+    def load_index(workflows):
+        if WorkflowMethods.index is not None:
+            return WorkflowMethods.index
+
+        cache_file = WorkflowMethods.cache_folder + 'workflows_index.pickle'
+        signature = WorkflowMethods.signature(workflows)
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_signature, index = pickle.load(f)
+            if cached_signature != signature:
+                index = None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            index = None
+
+        if index is None:
+            index = WorkflowMethods.build_index(workflows)
+            try:
+                os.makedirs(WorkflowMethods.cache_folder, exist_ok=True)
+                tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump((signature, index), f)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                pass  # Cache is only an optimization
+
+        WorkflowMethods.index = index
+        return index
+
+    @staticmethod
+    def lookup(flowcell, library, sequencer, workflows):
+        # Config names matching the requested flowcell, library and sequencer
+        conf_list = WorkflowMethods.load_index(workflows).get((flowcell, library), list())
+        if sequencer == 'promethion':
+            conf_list = [x for x in conf_list if 'prom' in x]  # Assume it will only return one...
+        return conf_list